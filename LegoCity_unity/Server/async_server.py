@@ -0,0 +1,191 @@
+"""
+Asyncio front end for the simulation API (same routes as server.py), built on aiohttp.
+
+Steps run in the session registry's worker pool, so a long step never blocks the event loop.
+Reads are served concurrently from the immutable snapshot of the last completed step,
+so they never see a half-stepped model. /stream waits for the runner's frames on the event loop
+(the runner wakes it up), so open streams don't take any thread.
+
+Run with:
+    pip install aiohttp
+    python async_server.py
+"""
+from aiohttp import web
+from legoCity_Agents.model import CityModel
+from sessions import SessionRegistry
+from snapshots import BINARY_MIMETYPE, collectChanges, prefersBinary
+from streaming import END_EVENT, KEEPALIVE_EVENT, SimulationRunner, stepEvent
+import asyncio
+import os
+
+sessions = SessionRegistry(CityModel,
+                           maxSessions = int(os.environ.get("LEGOCITY_MAX_SESSIONS", 8)),
+                           ttl = float(os.environ.get("LEGOCITY_SESSION_TTL", 600)),
+                           workers = int(os.environ.get("LEGOCITY_STEP_WORKERS", 4)))
+
+routes = web.RouteTableDef()
+
+def getSession(request):
+    """
+    Returns the session of the request (?session=<id> or the X-Session header).
+    Requests without an id use the last session created.
+    """
+    session = sessions.get(request.query.get('session') or request.headers.get('X-Session'))
+    if session is None:
+        raise web.HTTPNotFound(text='{"message": "Unknown or expired session. Call /init first."}',
+                               content_type='application/json')
+    return session
+
+def queryArg(request, name, kind):
+    """ Query parameter converted with kind, or None if it is missing or invalid (like request.args.get with type in Flask). """
+    try:
+        return kind(request.query[name])
+    except (KeyError, ValueError):
+        return None
+
+def jsonBody(body):
+    return web.Response(body=body, content_type='application/json')
+
+def wantsBinary(request):
+    """ Whether the client asked for the binary format (Accept: application/octet-stream) instead of JSON. """
+    return prefersBinary(request.headers.get('Accept'))
+
+def staticResponse(request, name):
+    """ Serves a precomputed payload from memory (304 if the client already has that version). """
+    body, etag = getSession(request).staticPayloads[name]
+    # Comparacion debil, igual que make_conditional en Flask (listas, W/"..." y *)
+    if any(tag.value in (etag, '*') for tag in request.if_none_match or ()):
+        return web.Response(status=304, headers={'ETag': f'"{etag}"'})
+    return web.Response(body=body, content_type='application/json', headers={'ETag': f'"{etag}"'})
+
+@routes.post('/init')
+async def initModel(request):
+    # Crear el modelo fuera del event loop (construir el grafo y las rutas toma tiempo)
+    session = await asyncio.get_running_loop().run_in_executor(None, sessions.create)
+    return web.json_response({"message":"Model initialized.", "session":session.id})
+
+@routes.get('/getCars')
+async def getCars(request):
+    snapshot = getSession(request).snapshot
+    if wantsBinary(request):
+        return web.Response(body=snapshot.carsBinary, content_type=BINARY_MIMETYPE)
+    return jsonBody(snapshot.carsJson)
+
+@routes.get('/getTrafficLights')
+async def getTrafficLights(request):
+    return jsonBody(getSession(request).snapshot.trafficLightsJson)
+
+@routes.get('/getArrivedCars')
+async def getArrivedCars(request):
+    snapshot = getSession(request).snapshot
+    if wantsBinary(request):
+        return web.Response(body=snapshot.arrivedCarsBinary, content_type=BINARY_MIMETYPE)
+    return jsonBody(snapshot.arrivedCarsJson)
+
+@routes.get('/metrics')
+async def getMetrics(request):
+    return jsonBody(getSession(request).snapshot.metricsJson)
+
+@routes.get('/getDestinations')
+async def getDestinations(request):
+    return staticResponse(request, "destinations")
+
+@routes.get('/getObstacles')
+async def getObstacles(request):
+    return staticResponse(request, "obstacles")
+
+@routes.get('/getRoads')
+async def getRoads(request):
+    return staticResponse(request, "roads")
+
+@routes.get('/getStaticWorld')
+async def getStaticWorld(request):
+    return staticResponse(request, "world")
+
+@routes.get('/update')
+async def updateModel(request):
+    currentStep = await asyncio.wrap_future(sessions.submit(getSession(request)))
+    return web.json_response({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
+
+@routes.get('/step')
+async def stepModel(request):
+    """ Advances the model one step and returns only what changed since ?since=<step> (see server.py). """
+    session = getSession(request)
+    since = queryArg(request, 'since', int)
+    if since is None:
+        since = session.snapshot.step
+
+    changes = await asyncio.wrap_future(sessions.submit(session, after = lambda s: collectChanges(s.model, since)))
+    return web.json_response(changes)
+
+@routes.post('/run')
+async def runModel(request):
+    """ Starts stepping the model in the background (?rate=<steps per second>, see server.py). """
+    session = getSession(request)
+    rate = queryArg(request, 'rate', float)
+
+    if session.runner is None:
+        session.runner = SimulationRunner(session, rate)
+    session.runner.rate = rate
+    # start puede esperar a que un hilo pausado termine su ultimo step
+    await asyncio.get_running_loop().run_in_executor(None, session.runner.start)
+
+    return web.json_response({"message":"Model running.", "session":session.id, "rate":rate})
+
+@routes.post('/pause')
+async def pauseModel(request):
+    session = getSession(request)
+    if session.runner is not None:
+        session.runner.stop()
+    return web.json_response({"message":"Model paused.", "session":session.id})
+
+@routes.get('/stream')
+async def streamModel(request):
+    """ Server-Sent Events with the changes of each step of a running model (see server.py). """
+    session = getSession(request)
+    if session.runner is None:
+        session.runner = SimulationRunner(session, None)
+    runner = session.runner
+
+    loop = asyncio.get_running_loop()
+    pushed = asyncio.Event()
+    subscriber = runner.subscribe(lambda: loop.call_soon_threadsafe(pushed.set))
+
+    response = web.StreamResponse(headers={"Cache-Control": "no-cache"})
+    response.content_type = 'text/event-stream'
+    await response.prepare(request)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(pushed.wait(), 15)
+            except asyncio.TimeoutError:
+                # Mantener viva la conexion mientras no hay steps nuevos (p. ej. antes de /run)
+                await response.write(KEEPALIVE_EVENT.encode())
+                continue
+
+            pushed.clear()
+            try:
+                frame = subscriber.next(timeout = 0)
+            except StopIteration:
+                await response.write(END_EVENT.encode())
+                break
+            if frame is not None:
+                changes, step = frame
+                await response.write(stepEvent(changes, step, subscriber.dropped).encode())
+    finally:
+        runner.unsubscribe(subscriber)
+    return response
+
+@routes.post('/close')
+async def closeSession(request):
+    session = getSession(request)
+    sessions.remove(session.id)
+    return web.json_response({"message":"Session closed.", "session":session.id})
+
+def createApp():
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+if __name__=='__main__':
+    web.run_app(createApp(), host="localhost", port=8585)
@@ -0,0 +1,147 @@
+"""
+Headless batch runner for CityModel.
+
+Sweeps map files, car generator times, traffic light times and seeds across a
+process pool (one model per worker) and writes every run to a single JSON file.
+
+Example:
+    python batch_run.py --generator-times 3 5 --short-light-times 5 6 --long-light-times 7 9 --seeds 0 1 2 --workers 4
+    python batch_run.py --check-reproducibility --seeds 0 1
+"""
+from concurrent.futures import ProcessPoolExecutor
+from legoCity_Agents.agent import Car
+from legoCity_Agents.model import CityModel, DEFAULT_MAP
+import argparse
+import itertools
+import json
+import time
+
+# Caracteres de los semaforos que empiezan en verde (cortos) y en rojo (largos)
+SHORT_LIGHTS = ["r", "l", "u", "d"]
+LONG_LIGHTS = ["R", "L", "U", "D"]
+
+
+def run_simulation(params):
+    '''
+    Runs one CityModel headlessly until it stops or reaches the number of steps.
+    Returns the parameters together with the results of the run.
+    '''
+    trafficLightTimes = {}
+    if params["shortLightTime"] is not None:
+        trafficLightTimes.update({character: params["shortLightTime"] for character in SHORT_LIGHTS})
+    if params["longLightTime"] is not None:
+        trafficLightTimes.update({character: params["longLightTime"] for character in LONG_LIGHTS})
+
+    start = time.perf_counter()
+    model = CityModel(mapFile = params["mapFile"], carGeneratorTime = params["generatorTime"],
+                      trafficLightTimes = trafficLightTimes, maxSteps = params["steps"],
+                      verbose = False, seed = params["seed"], intersectionControl = params["intersectionControl"])
+    initTime = time.perf_counter() - start
+
+    stepTimes = []
+    collisionStep = None
+    while model.running and model.schedule.steps < params["steps"]:
+        start = time.perf_counter()
+        model.step()
+        stepTimes.append(time.perf_counter() - start)
+
+        if collisionStep is None and model.checkCollision():
+            collisionStep = model.schedule.steps
+
+    return dict(params,
+                numArrivedCars = model.numArrivedCars,
+                numCars = model.numCars,
+                collisionStep = collisionStep,
+                steps = model.schedule.steps,
+                initTime = initTime,
+                totalTime = sum(stepTimes),
+                meanStepTime = sum(stepTimes) / len(stepTimes) if stepTimes else 0,
+                maxStepTime = max(stepTimes, default = 0),
+                stepTimes = stepTimes,
+                metrics = model.metrics.summary())
+
+
+def run_trace(mapFile, seed, steps):
+    '''
+    Runs one CityModel and returns, for each step, the arrived cars and the position of every car.
+    '''
+    model = CityModel(mapFile = mapFile, maxSteps = steps, verbose = False, seed = seed)
+
+    trace = []
+    while model.running and model.schedule.steps < steps:
+        model.step()
+        positions = sorted((a.unique_id, a.pos) for a in model.schedule.agents if isinstance(a, Car))
+        trace.append((model.schedule.steps, model.numArrivedCars, positions))
+    return trace
+
+
+def check_reproducibility(mapFile, seed, steps):
+    '''
+    Runs the same seed twice and returns the first step where the runs differ (None if they are identical).
+    '''
+    first = run_trace(mapFile, seed, steps)
+    second = run_trace(mapFile, seed, steps)
+
+    for a, b in zip(first, second):
+        if a != b:
+            return a[0]
+    if len(first) != len(second):
+        return min(len(first), len(second)) + 1
+    return None
+
+
+def build_runs(args):
+    ''' Returns the parameters of every run of the sweep (cartesian product of the options). '''
+    return [{"mapFile": mapFile, "generatorTime": generatorTime, "shortLightTime": shortLightTime,
+             "longLightTime": longLightTime, "intersectionControl": intersectionControl, "seed": seed, "steps": args.steps}
+            for mapFile, generatorTime, shortLightTime, longLightTime, intersectionControl, seed
+            in itertools.product(args.maps, args.generator_times, args.short_light_times,
+                                 args.long_light_times, args.intersection_control, args.seeds)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Run parameter sweeps over CityModel without a server.")
+    parser.add_argument("--maps", nargs = "+", default = [DEFAULT_MAP], help = "Map files to simulate")
+    parser.add_argument("--generator-times", nargs = "+", type = int, default = [None],
+                        help = "Steps between each generated car")
+    parser.add_argument("--short-light-times", nargs = "+", type = int, default = [None],
+                        help = "Steps between each change of the lights that start green (r, l, u, d)")
+    parser.add_argument("--long-light-times", nargs = "+", type = int, default = [None],
+                        help = "Steps between each change of the lights that start red (R, L, U, D)")
+    parser.add_argument("--intersection-control", nargs = "+", choices = ["independent", "grouped", "actuated"],
+                        default = ["independent"], help = "How the traffic lights of each intersection are stepped")
+    parser.add_argument("--seeds", nargs = "+", type = int, default = [0], help = "Seeds of each model")
+    parser.add_argument("--steps", type = int, default = 1000, help = "Steps of each run")
+    parser.add_argument("--workers", type = int, default = None, help = "Worker processes (one model per worker)")
+    parser.add_argument("--output", default = "batch_results.json", help = "JSON file with the results")
+    parser.add_argument("--check-reproducibility", action = "store_true",
+                        help = "Only check that each seed gives the same arrived cars and positions twice")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.check_reproducibility:
+        failed = False
+        for mapFile, seed in itertools.product(args.maps, args.seeds):
+            step = check_reproducibility(mapFile, seed, args.steps)
+            if step is not None:
+                failed = True
+                print(f"{mapFile} seed {seed}: runs differ at step {step}")
+            else:
+                print(f"{mapFile} seed {seed}: reproducible")
+        raise SystemExit(1 if failed else 0)
+
+    runs = build_runs(args)
+
+    print(f"Running {len(runs)} simulations...")
+    with ProcessPoolExecutor(max_workers = args.workers) as executor:
+        results = list(executor.map(run_simulation, runs))
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent = 2)
+
+    best = max(results, key = lambda r: (r["collisionStep"] is None, r["numArrivedCars"]))
+    print(f"Results saved to {args.output}")
+    print(f"Best run: {best['numArrivedCars']} arrived cars with {json.dumps({k: best[k] for k in ['mapFile', 'generatorTime', 'shortLightTime', 'longLightTime', 'intersectionControl', 'seed']})}")
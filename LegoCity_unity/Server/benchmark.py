@@ -0,0 +1,262 @@
+"""
+Benchmark suite for CityModel.
+
+Runs every city map of the repository headlessly for a fixed number of steps, also
+tiled into synthetic maps 10x and 100x larger, with different car generator times, and
+with the per-agent scheduler and/or the vectorized one (FleetActivation). A collision
+doesn't end a case: its first step is recorded and the case keeps running.
+Each case runs in a fresh process so its peak memory can be measured. The results
+are stored as JSON and can be compared against a previous run to catch regressions.
+
+Example:
+    python benchmark.py --scales 1 10 --generator-times 1 5 --output benchmark_results.json
+    python benchmark.py --compare benchmark_results.json --output new_results.json
+    python benchmark.py --engines agents vectorized --scales 10 --generator-times 5
+"""
+from concurrent.futures import ProcessPoolExecutor
+from legoCity_Agents.model import CityModel, DEFAULT_MAP, DEFAULT_DICTIONARY
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows no tiene el modulo resource (no se reporta la memoria)
+    resource = None
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(SERVER_DIR))
+
+MAPS = {
+    "base_city_2023": DEFAULT_MAP,
+    "2021_base": os.path.join(REPOSITORY_DIR, "MesaTests", "city_files", "2021_base.txt"),
+    "2022_base": os.path.join(REPOSITORY_DIR, "MesaTests", "city_files", "2022_base.txt"),
+    "mio": os.path.join(REPOSITORY_DIR, "MesaTests", "city_files", "mio.txt"),
+    "town_blocks": os.path.join(REPOSITORY_DIR, "LegoCity_unity", "LegoCity", "Assets", "Data", "town_blocks.txt"),
+    "unity_2022_base": os.path.join(REPOSITORY_DIR, "LegoCity_unity", "LegoCity", "Assets", "Data", "2022_base.txt"),
+}
+
+# Mapas viejos: 's'/'S' son semaforos (verde/rojo) sin direccion y 'D' es un destino
+LEGACY_LIGHTS = {"Right": "r", "Left": "l", "Up": "u", "Down": "d"}
+
+
+def read_map(mapFile):
+    ''' Returns the rows of a map file without line endings. '''
+    with open(mapFile) as baseFile:
+        return [line.rstrip("\n") for line in baseFile if line.strip()]
+
+
+def is_legacy(rows):
+    return any(character in row for row in rows for character in "sS")
+
+
+def light_direction(rows, r, c):
+    '''
+    Infers the direction of a legacy traffic light from the roads next to it,
+    looking first at the same row and then at the same column.
+    '''
+    for dc in (-1, 1):
+        if 0 <= c + dc < len(rows[r]) and rows[r][c + dc] in "<>":
+            return "Right" if rows[r][c + dc] == ">" else "Left"
+    for dr in (-1, 1):
+        if 0 <= r + dr < len(rows) and c < len(rows[r + dr]) and rows[r + dr][c] in "^v":
+            return "Up" if rows[r + dr][c] == "^" else "Down"
+    return "Right"
+
+
+def translate_legacy(rows):
+    ''' Translates a legacy map to the characters of mapDictionary.json. '''
+    translated = []
+    for r, row in enumerate(rows):
+        newRow = []
+        for c, character in enumerate(row):
+            if character == "D":
+                newRow.append("T")
+            elif character in "sS":
+                light = LEGACY_LIGHTS[light_direction(rows, r, c)]
+                newRow.append(light if character == "s" else light.upper())
+            else:
+                newRow.append(character)
+        translated.append("".join(newRow))
+    return translated
+
+
+def add_corner_generators(rows):
+    ''' Maps without car generators get one in each corner that is a road, so that they have traffic. '''
+    rows = [list(row) for row in rows]
+    for r, c in [(0, 0), (0, -1), (-1, 0), (-1, -1)]:
+        if rows[r][c] in "<>^vghbn":
+            rows[r][c] = "C"
+    return ["".join(row) for row in rows]
+
+
+def tile_map(rows, scale):
+    '''
+    Repeats the map to make it about `scale` times larger (in number of cells).
+    Returns the tiled rows and the number of tiles (horizontal, vertical).
+    '''
+    tilesX = max(d for d in range(1, math.isqrt(scale) + 1) if scale % d == 0)
+    tilesY = scale // tilesX
+    return [row * tilesX for row in rows] * tilesY, (tilesX, tilesY)
+
+
+def prepare_map(name, scale, directory):
+    '''
+    Writes the map ready to be loaded by CityModel (translated and tiled) in the directory.
+    Returns the path of the map, the path of its dictionary and the number of tiles.
+    '''
+    mapFile = MAPS[name]
+    rows = read_map(mapFile)
+
+    dictionaryFile = os.path.join(os.path.dirname(mapFile), "mapDictionary.json")
+    if not os.path.exists(dictionaryFile):
+        dictionaryFile = DEFAULT_DICTIONARY
+
+    if is_legacy(rows):
+        rows = translate_legacy(rows)
+    if not any("C" in row for row in rows):
+        rows = add_corner_generators(rows)
+
+    rows, tiles = tile_map(rows, scale)
+
+    path = os.path.join(directory, f"{name}_x{scale}.txt")
+    with open(path, "w") as output:
+        output.write("\n".join(rows) + "\n")
+    return path, dictionaryFile, tiles
+
+
+def run_case(case):
+    ''' Runs one benchmark case (in its own process) and returns its results. '''
+    with tempfile.TemporaryDirectory() as directory:
+        mapFile, dictionaryFile, tiles = prepare_map(case["map"], case["scale"], directory)
+
+        start = time.perf_counter()
+        model = CityModel(mapFile = mapFile, dictionaryFile = dictionaryFile, carGeneratorTime = case["generatorTime"],
+                          maxSteps = case["steps"], verbose = False, seed = case["seed"], stopOnCollision = False,
+                          tileSize = case["tileSize"], workers = case["workers"], vectorized = case["engine"] == "vectorized")
+        initTime = time.perf_counter() - start
+
+    # Se sigue despues de los choques para que todos los casos midan el mismo numero de steps
+    firstCollision = None
+    start = time.perf_counter()
+    while model.running and model.schedule.steps < case["steps"]:
+        model.step()
+        if firstCollision is None and model.grid.collisions:
+            firstCollision = model.schedule.steps
+    runTime = time.perf_counter() - start
+    model.close()
+
+    steps = model.schedule.steps
+    counters = model.metrics.counters
+    peakMemory = None
+    if resource is not None:
+        # ru_maxrss esta en KB en Linux
+        peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return dict(case,
+                width = model.width,
+                height = model.height,
+                tiles = tiles,
+                stepsRun = steps,
+                initTime = initTime,
+                runTime = runTime,
+                stepsPerSecond = steps / runTime if runTime else None,
+                peakMemoryBytes = peakMemory,
+                astarCallsPerStep = counters["astar_calls"] / steps if steps else 0,
+                numCars = model.numCars,
+                numArrivedCars = model.numArrivedCars,
+                collided = firstCollision is not None,
+                firstCollisionStep = firstCollision,
+                meanTimesPerStep = model.metrics.summary()["meanTimesPerStep"])
+
+
+def case_key(result):
+    # Sin los steps: los casos con otro numero de steps se reportan en compare en lugar de ignorarse
+    return (result["map"], result["scale"], result["generatorTime"], result["seed"], result.get("tileSize"),
+            result.get("engine", "agents"))
+
+
+def compare(results, baselineFile, tolerance):
+    '''
+    Compares the steps per second of each case against a previous run.
+    Returns the cases that got slower than the tolerance, and the cases that can't be compared because the
+    runs have a different number of steps (another --steps, or old results that stopped at the first collision).
+    '''
+    with open(baselineFile) as baseline:
+        previous = {case_key(r): r for r in json.load(baseline)["results"]}
+
+    regressions = []
+    mismatched = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if not old or not old["stepsPerSecond"] or not result["stepsPerSecond"]:
+            continue
+        # Los resultados viejos guardaban en steps los que se corrieron (se paraban en el primer choque)
+        oldSteps = old.get("stepsRun", old["steps"])
+        if oldSteps != result["stepsRun"]:
+            mismatched.append((case_key(result), oldSteps, result["stepsRun"]))
+            continue
+        change = result["stepsPerSecond"] / old["stepsPerSecond"] - 1
+        if change < -tolerance:
+            regressions.append((case_key(result), old["stepsPerSecond"], result["stepsPerSecond"], change))
+    return regressions, mismatched
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Benchmark CityModel over the city maps and traffic densities.")
+    parser.add_argument("--maps", nargs = "+", default = list(MAPS), choices = list(MAPS), help = "Maps to benchmark")
+    parser.add_argument("--scales", nargs = "+", type = int, default = [1, 10],
+                        help = "How many times larger the tiled maps are (100 is slow to initialize)")
+    parser.add_argument("--generator-times", nargs = "+", type = int, default = [1, 5],
+                        help = "Steps between each generated car")
+    parser.add_argument("--steps", type = int, default = 300, help = "Steps of each case")
+    parser.add_argument("--seed", type = int, default = 0, help = "Seed of each model")
+    parser.add_argument("--tile-size", type = int, default = None,
+                        help = "Plan the cars by tiles of this size in worker processes (see TiledActivation)")
+    parser.add_argument("--workers", type = int, default = None, help = "Worker processes of the tiled scheduler")
+    parser.add_argument("--engines", nargs = "+", default = ["agents"], choices = ["agents", "vectorized"],
+                        help = "How the cars are stepped: one Car.step per car, or all at once (see FleetActivation)")
+    parser.add_argument("--output", default = "benchmark_results.json", help = "JSON file with the results")
+    parser.add_argument("--compare", default = None, help = "Previous results to detect regressions")
+    parser.add_argument("--tolerance", type = float, default = 0.1,
+                        help = "Allowed drop of steps per second before a case is reported as a regression")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cases = [{"map": name, "scale": scale, "generatorTime": generatorTime, "steps": args.steps, "seed": args.seed,
+              "tileSize": args.tile_size, "workers": args.workers, "engine": engine}
+             for name in args.maps if os.path.exists(MAPS[name])
+             for scale in args.scales
+             for generatorTime in args.generator_times
+             for engine in args.engines]
+
+    results = []
+    for case in cases:
+        # Un proceso nuevo por caso para que la memoria maxima sea solo la de ese caso
+        # (no es un Pool: sus procesos son daemon y no podrian lanzar los workers de TiledActivation)
+        with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_case, case).result()
+            print(f"{result['map']:>16} x{result['scale']:<4} C={result['generatorTime']:<3} {result['engine']:>10} "
+                  f"{result['stepsPerSecond'] or 0:9.1f} steps/s  {result['astarCallsPerStep']:7.2f} A*/step  "
+                  f"{result['numArrivedCars']:6} arrived  init {result['initTime']:.2f}s"
+                  + (f"  first collision at step {result['firstCollisionStep']}" if result["collided"] else ""))
+            results.append(result)
+
+    with open(args.output, "w") as output:
+        json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, output, indent = 2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        regressions, mismatched = compare(results, args.compare, args.tolerance)
+        for key, old, new, change in regressions:
+            print(f"REGRESSION {key}: {old:.1f} -> {new:.1f} steps/s ({change:+.0%})")
+        for key, old, new in mismatched:
+            print(f"SKIPPED {key}: ran {new} steps, the baseline ran {old}")
+        raise SystemExit(1 if regressions else 0)
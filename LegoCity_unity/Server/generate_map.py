@@ -0,0 +1,259 @@
+"""
+Procedural city map generator for stress testing CityModel.
+
+Writes a grid of two-lane one-way streets of any size, in the characters of mapDictionary.json.
+Horizontal and vertical streets alternate their direction and the streets on the border go around
+the city, so every road can reach every other road. Each crossing can get traffic lights on the
+cells before it (the horizontal ones start green and the vertical ones red), and the blocks between
+the streets get destinations on their border and car generators with a road across the block to the street.
+
+No car can drive onto a generator or its road, but CityModel generates a car every carGeneratorTime steps
+even if the last one is still waiting there: the road only holds the cars generated while the street is
+full (blockSize - 2 of them, at least one). If the cars are generated faster than the streets take them,
+the streets jam, a new car is generated on top of a waiting one and the run stops on that collision.
+The default generator density (0.05 of the blocks, with the default carGeneratorTime) stayed free of
+collisions for a whole run (maxSteps = 1000) on 120x80 maps with both schedulers; 0.1 is near the limit,
+and 0.25 jams in about 100 steps.
+
+Example:
+    python generate_map.py --width 500 --height 500 --output city_500.txt
+    python generate_map.py --width 100 --height 60 --block-size 6 --generator-density 0.1 --seed 3 --output city.txt
+    python generate_map.py --validate legoCity_Agents/city_files/base_city_2023.txt
+"""
+from legoCity_Agents.mapcompiler import (compile_map, next_possible_steps, parse_map, unreachable_generators,
+                                         ROAD, TRAFFIC_LIGHT, OBSTACLE, CAR_GENERATOR, NO_DIRECTION, DIRECTION_CODES)
+from legoCity_Agents.model import DEFAULT_DICTIONARY
+import argparse
+import json
+import random
+
+# Caracter de cada cruce segun la direccion de la calle horizontal y la vertical
+CROSSINGS = {(">", "^"): "h", (">", "v"): "n", ("<", "^"): "g", ("<", "v"): "b"}
+
+
+def street_layout(size, blockSize):
+    '''
+    Splits one axis of the map into streets (2 cells wide) and blocks.
+    The number of streets is always even, so the first and the last one go in opposite directions.
+    Returns the first cell of every street and the (start, end) of every block.
+    '''
+    if size < 5:
+        raise ValueError(f"The map must be at least 5 cells wide and high, got {size}")
+
+    numBlocks = max(1, (size - 2) // (blockSize + 2))
+    if numBlocks % 2 == 0:
+        numBlocks -= 1
+    # Las celdas que sobran se reparten entre las manzanas
+    extra = size - 2 - numBlocks * (blockSize + 2)
+
+    streets = []
+    blocks = []
+    pos = 0
+    for i in range(numBlocks):
+        streets.append(pos)
+        pos += 2
+        length = blockSize + extra // numBlocks + (1 if i < extra % numBlocks else 0)
+        blocks.append((pos, pos + length))
+        pos += length
+    streets.append(pos)
+    return streets, blocks
+
+
+def block_border(xRange, yRange):
+    ''' Cells of a block next to a street, without and with the corners. '''
+    cells = [(x, y) for x in range(*xRange) for y in range(*yRange)
+             if x in (xRange[0], xRange[1] - 1) or y in (yRange[0], yRange[1] - 1)]
+    corners = {(x, y) for x in (xRange[0], xRange[1] - 1) for y in (yRange[0], yRange[1] - 1)}
+    return [pos for pos in cells if pos not in corners], cells
+
+
+def driveways(xRange, yRange):
+    '''
+    Possible car generators of a block: a generator one cell inside the block, as far as possible from the
+    horizontal street below or above the block, with a road across the block that leads it to that street.
+    The road holds the cars that were generated while the street was full.
+    Returns (generator, road cells, road character) tuples.
+    '''
+    options = []
+    for x in range(xRange[0] + 1, xRange[1] - 1):
+        if yRange[1] - yRange[0] >= 2:
+            # La orilla del otro lado se deja como obstaculo para que no entren los coches de esa calle
+            top = max(yRange[0] + 1, yRange[1] - 2)
+            bottom = min(yRange[1] - 2, yRange[0] + 1)
+            options.append(((x, top), [(x, y) for y in range(yRange[0], top)], "v"))
+            options.append(((x, bottom), [(x, y) for y in range(bottom + 1, yRange[1])], "^"))
+    return options
+
+
+def to_rows(cells):
+    ''' Returns the rows of the map (top row first) from its cells indexed as (x, y). '''
+    width, height = len(cells), len(cells[0])
+    return ["".join(cells[x][height - r - 1] for x in range(width)) for r in range(height)]
+
+
+def can_enter(cellTypes, directions, pos, exclude = ()):
+    ''' Whether a car on a neighbouring road (other than the cells in exclude) could move into the cell. '''
+    x, y = pos
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor = (x + dx, y + dy)
+            if (dx or dy) and neighbor not in exclude and \
+                    0 <= neighbor[0] < len(cellTypes) and 0 <= neighbor[1] < len(cellTypes[0]) and \
+                    cellTypes[neighbor[0]][neighbor[1]] in (ROAD, TRAFFIC_LIGHT) and \
+                    pos in next_possible_steps(cellTypes, directions, neighbor):
+                return True
+    return False
+
+
+def generate_map(width, height, blockSize = 4, generatorDensity = 0.05, destinationDensity = 0.5, lightDensity = 1.0,
+                 seed = None, dataDictionary = None):
+    '''
+    Generates a city map.
+    Args:
+        width: Width of the map (cells)
+        height: Height of the map (cells)
+        blockSize: Size of the blocks between the streets (the remaining cells make some blocks larger)
+        generatorDensity: Fraction of the blocks with a car generator (higher densities jam, see the module docstring)
+        destinationDensity: Fraction of the blocks with a destination
+        lightDensity: Fraction of the crossings with traffic lights
+        seed: Seed of the generator
+        dataDictionary: Dictionary of the map characters (mapDictionary.json by default)
+    Returns the rows of the map (top row first, without line endings).
+    '''
+    rng = random.Random(seed)
+    if dataDictionary is None:
+        with open(DEFAULT_DICTIONARY) as dictionary:
+            dataDictionary = json.load(dictionary)
+
+    streetsX, blocksX = street_layout(width, blockSize)
+    streetsY, blocksY = street_layout(height, blockSize)
+
+    # Todo empieza como obstaculo, indexado como (x, y) igual que el grid
+    cells = [["#"] * height for _ in range(width)]
+    horizontal = {}
+    vertical = {}
+    for i, y0 in enumerate(streetsY):
+        for y in (y0, y0 + 1):
+            horizontal[y] = ">" if i % 2 == 0 else "<"
+            for x in range(width):
+                cells[x][y] = horizontal[y]
+    for j, x0 in enumerate(streetsX):
+        for x in (x0, x0 + 1):
+            vertical[x] = "v" if j % 2 == 0 else "^"
+            for y in range(height):
+                cells[x][y] = CROSSINGS[(horizontal[y], vertical[x])] if y in horizontal else vertical[x]
+
+    # Semaforos en las celdas antes de cada cruce
+    for x0 in streetsX:
+        for y0 in streetsY:
+            if rng.random() >= lightDensity:
+                continue
+            lights = []
+            # Calle horizontal (empieza en verde)
+            before = x0 - 1 if horizontal[y0] == ">" else x0 + 2
+            if 0 <= before < width and before not in vertical:
+                character = "r" if horizontal[y0] == ">" else "l"
+                lights += [(before, y0, character), (before, y0 + 1, character)]
+            # Calle vertical (empieza en rojo)
+            before = y0 - 1 if vertical[x0] == "^" else y0 + 2
+            if 0 <= before < height and before not in horizontal:
+                character = "U" if vertical[x0] == "^" else "D"
+                lights += [(x0, before, character), (x0 + 1, before, character)]
+            for x, y, character in lights:
+                cells[x][y] = character
+
+    blocks = [(xRange, yRange) for xRange in blocksX for yRange in blocksY]
+
+    # Generadores: solo donde ningun otro coche puede entrar (ni a su calle de salida); la salida guarda los coches
+    # que se generan mientras la calle esta llena, pero si se llena tambien, el siguiente coche choca
+    cellType, direction = parse_map([row + "\n" for row in to_rows(cells)], dataDictionary)[2:]
+    cellTypes, directions = cellType.tolist(), direction.tolist()
+    order = blocks[:]
+    rng.shuffle(order)
+    wanted = max(1, round(generatorDensity * len(blocks)))
+    generators = 0
+    for xRange, yRange in order:
+        if generators == wanted:
+            break
+        options = driveways(xRange, yRange)
+        rng.shuffle(options)
+        for (gx, gy), road, character in options:
+            cellTypes[gx][gy] = CAR_GENERATOR
+            for rx, ry in road:
+                cellTypes[rx][ry], directions[rx][ry] = ROAD, DIRECTION_CODES[dataDictionary[character]]
+            # Solo los coches de la misma salida pueden entrar a ella
+            if any(can_enter(cellTypes, directions, pos, road) for pos in [(gx, gy), *road]):
+                cellTypes[gx][gy] = OBSTACLE
+                for rx, ry in road:
+                    cellTypes[rx][ry], directions[rx][ry] = OBSTACLE, NO_DIRECTION
+                continue
+            cells[gx][gy] = "C"
+            for rx, ry in road:
+                cells[rx][ry] = character
+            generators += 1
+            break
+
+    # Destinos: en la orilla de la manzana, fuera de las esquinas cuando se puede
+    rng.shuffle(order)
+    for xRange, yRange in order[:max(1, round(destinationDensity * len(blocks)))]:
+        edges, border = block_border(xRange, yRange)
+        candidates = [pos for pos in edges if cells[pos[0]][pos[1]] == "#"] or \
+                     [pos for pos in border if cells[pos[0]][pos[1]] == "#"]
+        if candidates:
+            x, y = rng.choice(candidates)
+            cells[x][y] = "T"
+
+    return to_rows(cells)
+
+
+def validate_map(lines, dataDictionary):
+    '''
+    Checks a map (its lines, with line endings) against the graph CityModel builds.
+    Returns a list of problems (empty if every car generator can reach some destination).
+    '''
+    compiledMap = compile_map(lines, dataDictionary, cacheDir = None)
+    problems = []
+    if not any("C" in line for line in lines):
+        problems.append("The map has no car generators")
+    if not any("T" in line for line in lines):
+        problems.append("The map has no destinations")
+    problems += [f"Car generator at {pos} can't reach any destination" for pos in unreachable_generators(compiledMap)]
+    return problems
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Generate (or validate) city maps of any size.")
+    parser.add_argument("--width", type = int, default = 500, help = "Width of the map")
+    parser.add_argument("--height", type = int, default = 500, help = "Height of the map")
+    parser.add_argument("--block-size", type = int, default = 4, help = "Size of the blocks between the streets")
+    parser.add_argument("--generator-density", type = float, default = 0.05,
+                        help = "Fraction of the blocks with a car generator (above about 0.1 the streets jam)")
+    parser.add_argument("--destination-density", type = float, default = 0.5, help = "Fraction of the blocks with a destination")
+    parser.add_argument("--light-density", type = float, default = 1.0, help = "Fraction of the crossings with traffic lights")
+    parser.add_argument("--seed", type = int, default = 0, help = "Seed of the generator")
+    parser.add_argument("--dictionary", default = DEFAULT_DICTIONARY, help = "Dictionary of the map characters")
+    parser.add_argument("--output", default = "generated_city.txt", help = "Map file to write")
+    parser.add_argument("--validate", default = None, metavar = "MAP", help = "Only validate an existing map file")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.dictionary) as dictionary:
+        dataDictionary = json.load(dictionary)
+
+    if args.validate:
+        with open(args.validate) as mapFile:
+            problems = validate_map(mapFile.readlines(), dataDictionary)
+    else:
+        rows = generate_map(args.width, args.height, args.block_size, args.generator_density, args.destination_density,
+                            args.light_density, args.seed, dataDictionary)
+        problems = validate_map([row + "\n" for row in rows], dataDictionary)
+        if not problems:
+            with open(args.output, "w") as output:
+                output.write("\n".join(rows) + "\n")
+            print(f"Map of {args.width}x{args.height} saved to {args.output}")
+
+    for problem in problems:
+        print(problem)
+    raise SystemExit(1 if problems else 0)
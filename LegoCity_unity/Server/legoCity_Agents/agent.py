@@ -1,65 +1,163 @@
 from mesa import Agent
-import networkx as nx
-import random
-import copy
+from legoCity_Agents.pathfinding import lane_change_path
 
 
 class Car(Agent):
     """
     Agent that moves randomly.
+    Every attribute of a car (also the ones set by Agent) lives in a slot. Agent has no __slots__, so a
+    car still has a __dict__, but it is never filled and Python only creates it if something asks for it,
+    so large fleets stay small in memory. The path is the route shared by every car that
+    asked for the same route plus a cursor to the next cell, so moving doesn't copy or shift a list.
     Attributes:
-        unique_id: Agent's ID 
-        direction: Randomly chosen direction chosen from one of eight directions
+        unique_id: Agent's ID (integer, also used by the binary wire format)
+        destinationAgent: Destination the car goes to
+        route: Tuple with the cells of the current route (shared with the route table)
+        cursor: Index in route of the next cell
+        estado: Whether the car moved in its last step
     """
+    __slots__ = ("unique_id", "model", "pos", "destinationAgent", "route", "cursor", "estado")
+
     def __init__(self, unique_id, model, destinationAgent):
         """
         Creates a new random agent.
         Args:
-            unique_id: The agent's ID
+            unique_id: The agent's ID (integer)
             model: Model reference for the agent
+            destinationAgent: Destination the car goes to
         """
         self.destinationAgent = destinationAgent
-        self.path = []
+        self.route = ()
+        self.cursor = 0
         self.estado = True
 
 
         super().__init__(unique_id, model)
 
+    @property
+    def index(self):
+        ''' Integer ID of the car (used by the binary wire format). '''
+        return self.unique_id
+
+    @property
+    def path(self):
+        ''' Cells of the route that the car hasn't visited yet. '''
+        return list(self.route[self.cursor:])
+
+    @path.setter
+    def path(self, path):
+        self.route = tuple(path)
+        self.cursor = 0
+
+    def remaining(self):
+        ''' Number of cells left in the route. '''
+        return len(self.route) - self.cursor
+
+    def nextCell(self):
+        ''' Next cell of the route, or None if the route is finished. '''
+        return self.route[self.cursor] if self.cursor < len(self.route) else None
+
+    def extendRoute(self, cells = 5):
+        '''
+        Adds the next parts of the route until at least `cells` cells are left or it reaches the destination
+        (HierarchicalRouter returns the route one cluster at a time; with RouteTable there is nothing to add).
+        '''
+        destination = self.destinationAgent.pos
+        if not 0 < self.remaining() < cells or self.route[-1] == destination:
+            return
+
+        path = self.path
+        while len(path) < cells and path[-1] != destination:
+            part = self.model.routeTable.route(path[-1], destination)
+            if not part:
+                break
+            path += part
+        self.path = path
+
     def move(self, model):
         """ 
         Determines if the agent can move in the direction that was chosen
         """
-        if self.path == []:
-            self.calculate_ShortestPath(self.model.graph)
+        if self.cursor == len(self.route):
+            with model.metrics.timer("route"):
+                self.calculate_ShortestPath()
+            model.metrics.count("route_lookups")
+
+        if self.cursor < len(self.route):
+            # Con reservaciones la ruta puede repetir la celda: el coche espera un step
+            if self.route[self.cursor] == self.pos:
+                self.cursor += 1
+                self.estado = False
+                return
+
+            with model.metrics.timer("Car.canMove"):
+                canMove = self.canMove(model)
 
-        if self.path:
-            if self.canMove(model):
-                self.estado = True
-                next_move = self.path.pop(0)
-                model.grid.move_agent(self, next_move)
+            if canMove:
+                self.advance(model)
+            elif model.planner is not None and self.keepPlan(model):
+                self.advance(model)
             else:
                 self.estado = False
 
+    def keepPlan(self, model):
+        """
+        With reservations, when the car can't follow its plan: plans again if there is a car in the way
+        (and the route is long enough, like changeLane), or else moves its reservations one step later.
+        Returns whether the car can move now.
+        """
+        light = model.grid.trafficLightAt(self.pos)
+        if (light is None or light.state) and self.remaining() >= 5:
+            return self.replan()
+
+        model.planner.hold(self.unique_id, self.pos, self.route[self.cursor:], model.schedule.steps)
+        return False
+
+    def replan(self):
+        """
+        Plans again around the reserved cells when the car can't follow its plan (only with reservations),
+        so its reservations (waiting where it is) stay up to date. Returns whether it can move now.
+        """
+        model = self.model
+        self.path = self.cooperativePath()
+        model.metrics.count("astar_calls")
+        if not self.route:
+            return False
+
+        # Si el nuevo plan empieza esperando, este step ya es la espera
+        if self.route[0] == self.pos:
+            self.cursor = 1
+            return False
+
+        light = model.grid.trafficLightAt(self.pos)
+        return (light is None or light.state) and not model.grid.hasCar(self.route[0])
+
+    def advance(self, model):
+        """
+        Moves the car to the next cell of its path
+        """
+        self.estado = True
+        next_move = self.route[self.cursor]
+        self.cursor += 1
+        model.grid.move_agent(self, next_move)
+        model.delta.car_moved(self)
+        if next_move == self.destinationAgent.pos:
+            model.carArrived(self)
+
     def canMove(self, model):
         """
         Determines if the agent can move in the direction that was chosen
         """
-        next_move = self.path[0]
-
-        next_car = None
-        self_tf = None
+        next_move = self.route[self.cursor]
 
-        for agent in model.grid[self.pos[0]][self.pos[1]]:
-            if isinstance(agent, Traffic_Light):
-                self_tf = agent
-        for agent in model.grid[next_move[0]][next_move[1]]:
-            if isinstance(agent, Car):
-                next_car = agent
+        # Lectura directa de las capas del grid (sin recorrer los agentes de la celda)
+        next_car = model.grid.hasCar(next_move)
+        self_tf = model.grid.trafficLightAt(self.pos)
 
         # En semaforo
         if self_tf:
             if self_tf.state: 
-                if next_car == None:
+                if not next_car:
                     return True
                 else:
                     return False
@@ -68,7 +166,9 @@ class Car(Agent):
             
         # Coche adelate
         elif next_car:
-            if self.changeLane():
+            with model.metrics.timer("Car.changeLane"):
+                changedLane = self.changeLane()
+            if changedLane:
                 return True
 
             return False
@@ -81,11 +181,26 @@ class Car(Agent):
         
         return True
 
-    def calculate_ShortestPath(self, graph):
+    def calculate_ShortestPath(self):
         """ 
-        Will calculate the shortest path to the destination, taking into account 3 steps ahead
+        Will look up the shortest path to the destination in the model's precomputed route table,
+        or plan the next steps around the reserved cells if the model uses reservations
         """
-        self.path = nx.astar_path(graph, self.pos, self.destinationAgent.pos, weight='weight')[1:]
+        if self.model.planner is not None:
+            self.path = self.cooperativePath()
+        else:
+            self.route = self.model.routeTable.route(self.pos, self.destinationAgent.pos)
+            self.cursor = 0
+
+    def cooperativePath(self):
+        """
+        Plans (and reserves) the next steps of the car with the model's CooperativePlanner
+        """
+        model = self.model
+        light = model.grid.trafficLightAt(self.pos)
+        model.metrics.count("cooperative_plans")
+        return model.planner.plan(self.unique_id, self.pos, self.destinationAgent.pos, model.schedule.steps,
+                                  model.grid.hasCar, light is None or light.state)
         # print(self.path)
 
 
@@ -99,42 +214,20 @@ class Car(Agent):
         """ 
         Will calculate the shortest path if it can change lane
         """
-        if len(self.path) >= 5:
+        # Con reservaciones el coche vuelve a planear en move (replan)
+        if self.model.planner is not None:
+            return False
+
+        self.extendRoute(5)
+        if self.remaining() >= 5:
             # print("--------------",self.pos, "--------------", "changeLane")
-            successors = list(self.model.graph.successors(self.pos))
-            
-            # print(successors)
-            next_successors = []
-            for i in successors:
-                next_successors.append(list(self.model.graph.successors(i)))
-
-            successors = list(zip(successors, next_successors))
-
-            graph_copy = copy.deepcopy(self.model.graph)
-
-            for f in successors:
-                # print("f:", f)
-                next_step = self.model.grid[f[0][0]][f[0][1]]
-                for g in next_step:
-                    if isinstance(g, Car):
-                        # print("self.pos:", self.pos, "g.pos", g.pos)
-                        graph_copy[self.pos][g.pos]['weight'] = 1000
-
-                for h in f[1]:
-                    next_next_step = self.model.grid[h[0]][h[1]]
-                    for l in next_next_step:
-                        if isinstance(l, Car):
-                            # print("f:", f, "l.pos",l.pos)
-                            graph_copy[f[0]][l.pos]['weight'] = 1000
-                            
-            self.path = nx.astar_path(graph_copy, self.pos, self.destinationAgent.pos, weight='weight')[1:]
-
-            # Check if the path is valid
-            if self.path:
-                next_move_agents = self.model.grid[self.path[0][0]][self.path[0][1]]
-                for z in next_move_agents:
-                    if isinstance(z, Car):
-                        return False
+            # Hasta el final de la ruta actual (el destino, o el final del tramo con HierarchicalRouter)
+            self.path = lane_change_path(self.model.pathFinder, self.model.grid.hasCar, self.pos, self.route[-1])
+            self.model.metrics.count("astar_calls")
+
+            # Check if the path is valid (sin ruta se vuelve a calcular en el siguiente step)
+            if not self.route or self.model.grid.hasCar(self.route[0]):
+                return False
                 
             return True
 
@@ -145,7 +238,8 @@ class Car(Agent):
         """ 
         Determines the new direction it will take, and then moves
         """
-        self.move(self.model)
+        with self.model.metrics.timer("Car.move"):
+            self.move(self.model)
 #----------------------------------------------------------------------------------------------
 class Traffic_Light(Agent):
     """
@@ -165,13 +259,84 @@ class Traffic_Light(Agent):
         self.state = state
         self.timeToChange = list_TimeToChange_Direction[0]
         self.direction = list_TimeToChange_Direction[1]
+        # Step (modulo timeToChange) en el que cambia el semaforo
+        self.offset = 0
 
     def step(self):
         """ 
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
         """
-        if self.model.schedule.steps % self.timeToChange == 0:
-            self.state = not self.state
+        with self.model.metrics.timer("Traffic_Light"):
+            if (self.model.schedule.steps - self.offset) % self.timeToChange == 0:
+                self.state = not self.state
+                self.model.delta.light_changed(self)
+#----------------------------------------------------------------------------------------------
+class Intersection(Agent):
+    """
+    Controller of the traffic lights of one intersection (neighbouring lights, diagonals included).
+    In the "grouped" and "actuated" modes it is the scheduled agent, and every light of the
+    intersection changes at the same step, so the lights keep the opposite states they start with.
+    In the "independent" mode it is not scheduled and each light changes on its own.
+    Attributes:
+        lights: Traffic lights of the intersection
+        approaches: Dictionary traffic light -> cells whose cars are waiting for that light (its own cell included)
+        timeToChange: Steps between each change of the lights
+        offset: Step (modulo timeToChange) in which the lights change
+        mode: "independent", "grouped" (fixed time) or "actuated" (extends the green while its queue is longer)
+        maxExtension: Maximum steps a change can be postponed in the actuated mode
+    """
+    def __init__(self, unique_id, model, lights, approaches, mode = "grouped", maxExtension = 5):
+        super().__init__(unique_id, model)
+        self.lights = lights
+        self.approaches = approaches
+        self.mode = mode
+        self.maxExtension = maxExtension
+        self.extension = 0
+        # Todos cambian con el ciclo mas corto del grupo (el de los semaforos que empiezan en verde)
+        self.timeToChange = min(light.timeToChange for light in lights)
+        self.offset = 0
+        self.lastChange = -self.timeToChange
+        if mode != "independent":
+            self.set_timing(self.timeToChange, self.offset)
+
+    def set_timing(self, timeToChange, offset):
+        ''' Sets the time to change and offset of the intersection and of its lights. '''
+        self.timeToChange = timeToChange
+        self.offset = offset % timeToChange
+        # Para el modo actuado: el primer cambio es en el step offset
+        self.lastChange = self.offset - timeToChange
+        for light in self.lights:
+            light.timeToChange = self.timeToChange
+            light.offset = self.offset
+
+    def queue(self, state):
+        ''' Number of cars waiting for the lights of the intersection that are in the given state. '''
+        carCount = self.model.grid.carCount
+        return sum(int(carCount[pos]) for light in self.lights if light.state == state for pos in self.approaches[light])
+
+    def switch(self):
+        for light in self.lights:
+            light.state = not light.state
+            self.model.delta.light_changed(light)
+
+    def step(self):
+        """ 
+        Changes every light of the intersection when its time comes (or later, in the actuated mode, while the green queue is longer).
+        """
+        with self.model.metrics.timer("Intersection"):
+            steps = self.model.schedule.steps
+            if self.mode == "actuated":
+                change = steps - self.lastChange >= self.timeToChange
+                if change and self.extension < self.maxExtension and self.queue(True) > self.queue(False):
+                    self.extension += 1
+                    change = False
+            else:
+                change = (steps - self.offset) % self.timeToChange == 0
+
+            if change:
+                self.switch()
+                self.lastChange = steps
+                self.extension = 0
 #----------------------------------------------------------------------------------------------
 class Destination(Agent):
     """
@@ -228,18 +393,29 @@ class Car_Generator(Agent):
         """
         self.timeToGenerate = list_TimeToGenerate_Direction[0]
         self.direction = list_TimeToGenerate_Direction[1]
+        # Destinos a los que se puede llegar desde este generador (se calcula al generar el primer coche)
+        self.destinations = None
 
     def generate_Car(self, model):
-        destinationAgent = random.choice(model.destinationsList)
-        agent = Car(f"c_{self.pos[0]} {self.pos[1]} {model.numCars +1000}", model, destinationAgent)
+        if self.destinations is None:
+            self.destinations = [d for d in model.destinationsList if model.routeTable.reachable(self.pos, d.pos)]
+        # Si no hay ningun destino alcanzable, el coche se quedaria atorado en el generador
+        if not self.destinations:
+            return
+
+        # Usar el generador del modelo para que las corridas sean reproducibles con la misma semilla
+        destinationAgent = model.random.choice(self.destinations)
+        agent = Car(model.numCars, model, destinationAgent)
         model.numCars += 1
         model.grid.place_agent(agent, self.pos)
         model.schedule.add(agent)
+        model.delta.car_spawned(agent)
 
 
     def step(self):
         """ 
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
         """
-        if self.model.schedule.steps % self.timeToGenerate == 0:
-            self.generate_Car(self.model)
\ No newline at end of file
+        with self.model.metrics.timer("Car_Generator"):
+            if self.model.schedule.steps % self.timeToGenerate == 0:
+                self.generate_Car(self.model)
\ No newline at end of file
@@ -0,0 +1,59 @@
+class StepDelta:
+    """
+    Changes of the model during one or more steps, so a client only receives what changed.
+    Attributes:
+        spawned: Dictionary car id -> position of the cars that were generated
+        moved: Dictionary car id -> new position of the cars that moved (not counting the spawned ones)
+        arrived: Ids of the cars that arrived to their destination (they are removed on the next step)
+        lights: Dictionary traffic light id -> new state of the traffic lights that changed
+    """
+    def __init__(self):
+        self.spawned = {}
+        self.moved = {}
+        self.arrived = []
+        self.lights = {}
+
+    def car_spawned(self, car):
+        self.spawned[car.unique_id] = car.pos
+
+    def car_moved(self, car):
+        if car.unique_id in self.spawned:
+            self.spawned[car.unique_id] = car.pos
+        else:
+            self.moved[car.unique_id] = car.pos
+
+    def car_arrived(self, car):
+        self.arrived.append(car.unique_id)
+
+    def light_changed(self, light):
+        self.lights[light.unique_id] = light.state
+
+    def merge(self, other):
+        '''
+        Adds the changes of a later delta to this one.
+        A car that was spawned and arrived inside the merged steps is not reported at all.
+        '''
+        for carId, pos in other.spawned.items():
+            self.spawned[carId] = pos
+        for carId, pos in other.moved.items():
+            if carId in self.spawned:
+                self.spawned[carId] = pos
+            else:
+                self.moved[carId] = pos
+        for carId in other.arrived:
+            if carId in self.spawned:
+                del self.spawned[carId]
+            else:
+                self.moved.pop(carId, None)
+                self.arrived.append(carId)
+        self.lights.update(other.lights)
+        return self
+
+    def as_dict(self):
+        ''' Returns the delta with the same fields the other endpoints use. '''
+        return {
+            "spawned": [{"id": str(carId), "x": pos[0], "y": 1, "z": pos[1]} for carId, pos in self.spawned.items()],
+            "moved": [{"id": str(carId), "x": pos[0], "y": 1, "z": pos[1]} for carId, pos in self.moved.items()],
+            "arrived": [{"id": str(carId)} for carId in self.arrived],
+            "trafficLights": [{"id": str(lightId), "state": state} for lightId, state in self.lights.items()],
+        }
@@ -0,0 +1,131 @@
+from legoCity_Agents.pathfinding import lane_change_path
+from legoCity_Agents.scheduling import CarPhaseActivation
+import numpy as np
+
+
+class FleetActivation(CarPhaseActivation):
+    """
+    Scheduler that steps every car at once with NumPy instead of calling Car.step for each one.
+    Each step:
+        1. The agents that are not cars (traffic lights, intersections, car generators) step in random order.
+        2. The cars without a route look it up, and the next cell of every car is read from its route.
+        3. With masks over the grid layers, every car that isn't on a red light tries to move. The moves
+           are settled in rounds: in each round the cars whose next cell is free move, and if several cars
+           want the same cell the first one in the random order gets it. A car can follow another one that
+           moved in an earlier round, and no two cars ever end in the same cell.
+        4. The cars that are still behind a car (and not on a traffic light) try to change lanes, like
+           Car.canMove, and the ones with a free next cell are settled in more rounds.
+        5. All the moves are applied to the grid in one go (CityGrid.move_cars).
+    """
+    def step_cars(self, cars):
+        model = self.model
+        with model.metrics.timer("FleetActivation.routes"):
+            routeTable = model.routeTable
+            lookups = 0
+            for car in cars:
+                if car.cursor == len(car.route):
+                    car.route = routeTable.route(car.pos, car.destinationAgent.pos)
+                    car.cursor = 0
+                    lookups += 1
+            model.metrics.count("route_lookups", lookups)
+            cars = [car for car in cars if car.cursor < len(car.route)]
+
+        if cars:
+            with model.metrics.timer("FleetActivation.kernel"):
+                moving = self.settle(cars)
+            with model.metrics.timer("FleetActivation.apply"):
+                self.apply(cars, moving)
+
+    def settle(self, cars):
+        '''
+        Decides which cars move this step (the cars are in activation order and all have a route).
+        Returns a boolean array with the cars that move.
+        '''
+        model = self.model
+        grid = model.grid
+        height = grid.height
+
+        positions = np.array([car.pos for car in cars])
+        source = positions[:, 0] * height + positions[:, 1]
+        target = self.targets(cars)
+        remaining = np.fromiter((len(car.route) - car.cursor for car in cars), dtype = np.int64, count = len(cars))
+
+        count = grid.carCount.ravel().copy()
+        lightIndex = grid.trafficLightIndex.ravel()[source]
+        onLight = lightIndex >= 0
+        green = np.zeros(len(cars), dtype = bool)
+        if grid.trafficLights:
+            states = np.array([light.state for light in grid.trafficLights], dtype = bool)
+            green[onLight] = states[lightIndex[onLight]]
+
+        # Igual que Car.canMove: en semaforo solo se avanza en verde
+        moving = np.zeros(len(cars), dtype = bool)
+        self.settle_rounds(np.where(onLight, green, True), source, target, count, moving)
+
+        # Los que siguen detras de un coche (fuera de los semaforos) intentan cambiar de carril, viendo los coches
+        # donde quedaron despues de los movimientos anteriores
+        blocked = np.flatnonzero(~moving & ~onLight & (count[target] > 0))
+        short = blocked[remaining[blocked] < 5]
+        self.extend_routes([cars[i] for i in short])
+        remaining[short] = [cars[i].remaining() for i in short]
+        laneChanges = blocked[remaining[blocked] >= 5]
+        if laneChanges.size:
+            pathFinder = model.pathFinder
+
+            def hasCar(pos):
+                return count[pos[0] * height + pos[1]] > 0
+
+            for i in laneChanges:
+                car = cars[i]
+                car.path = lane_change_path(pathFinder, hasCar, car.pos, car.route[-1])
+            model.metrics.count("astar_calls", laneChanges.size)
+
+            target[laneChanges] = self.targets([cars[i] for i in laneChanges])
+            wants = np.zeros(len(cars), dtype = bool)
+            wants[laneChanges] = target[laneChanges] >= 0
+            self.settle_rounds(wants, source, target, count, moving)
+
+        return moving
+
+    def settle_rounds(self, wants, source, target, count, moving):
+        '''
+        Moves (in count and moving) the cars that want to move, in rounds, while their next cell is free.
+        In each round only one car enters each cell: the first one in the random order.
+        '''
+        pending = wants & ~moving
+        while True:
+            candidates = np.flatnonzero(pending & (count[target] == 0))
+            if not candidates.size:
+                break
+            _, first = np.unique(target[candidates], return_index = True)
+            chosen = candidates[first]
+            moving[chosen] = True
+            pending[chosen] = False
+            np.subtract.at(count, source[chosen], 1)
+            count[target[chosen]] += 1
+
+    def targets(self, cars):
+        ''' Returns the cell index of the next cell of each car (-1 for the cars without a route). '''
+        height = self.model.grid.height
+        return np.fromiter((car.route[car.cursor][0] * height + car.route[car.cursor][1]
+                            if car.cursor < len(car.route) else -1 for car in cars),
+                           dtype = np.int64, count = len(cars))
+
+    def apply(self, cars, moving):
+        ''' Moves the chosen cars, and updates their state, the step's changes and the arrivals. '''
+        model = self.model
+        movers = []
+        positions = []
+        for car, moves in zip(cars, moving.tolist()):
+            car.estado = moves
+            if moves:
+                movers.append(car)
+                positions.append(car.route[car.cursor])
+                car.cursor += 1
+
+        model.grid.move_cars(movers, positions)
+
+        for car, pos in zip(movers, positions):
+            model.delta.car_moved(car)
+            if pos == car.destinationAgent.pos:
+                model.carArrived(car)
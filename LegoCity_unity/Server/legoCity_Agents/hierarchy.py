@@ -0,0 +1,325 @@
+from itertools import count
+from legoCity_Agents.routing import dijkstra
+import heapq
+import numpy as np
+
+# Costo que se usa en lugar de infinito para las celdas sin camino a (o desde) un landmark
+UNREACHABLE = 10 ** 9
+
+
+class HierarchicalRouter:
+    """
+    Two-level router for large maps (HPA*), with the same route and reachable methods as RouteTable.
+    The grid is split into square clusters, and the abstract graph has as nodes the cells where an
+    edge crosses from one cluster to another (portals). Its edges are the crossing edges, plus the
+    shortest path inside a cluster from each portal to the cluster's exits, found with a Dijkstra
+    that never leaves the cluster. Every path splits into runs inside one cluster joined by crossing
+    edges, so the routes found on the abstract graph are still the shortest ones.
+    The abstract search is guided by landmarks (ALT): the exact distances from and to a few cells near
+    the corners of the map give a lower bound of the distance between any two cells, much tighter than
+    the straight line on a grid of one-way streets. Those are the only searches done when the router
+    is created: the tree of a portal is built the first time the abstract search reaches it, and kept
+    for the next queries.
+    A route is returned one cluster at a time (up to the first cell of the next cluster), so the cells
+    are only expanded as the car moves; the rest of the abstract path is remembered, so the next part
+    doesn't need another search.
+    Attributes:
+        width: Width of the grid
+        height: Height of the grid
+        clusterSize: Side of each cluster (cells)
+        landmarks: Cells used as landmarks
+        routes: Dictionary (source cell, destination position) -> part of the route already expanded
+    """
+    def __init__(self, compiledMap, destinations, clusterSize = 16, numLandmarks = 4):
+        """
+        Creates the router.
+        Args:
+            compiledMap: CompiledMap of the city (CityModel.compiledMap)
+            destinations: Positions of the destinations
+            clusterSize: Side of each cluster (cells)
+            numLandmarks: Number of landmarks (taken from the corners, then the middle of the sides)
+        """
+        self.width = compiledMap.width
+        self.height = compiledMap.height
+        self.clusterSize = clusterSize
+        self.routes = {}
+
+        height = self.height
+        numCells = self.width * height
+        self._indptr = compiledMap.indptr.tolist()
+        self._indices = compiledMap.indices.tolist()
+        self._weights = compiledMap.weights.tolist()
+        self.minWeight = min(self._weights, default = 1)
+
+        cells = np.arange(numCells)
+        clustersY = -(-height // clusterSize)
+        cluster = (cells // height // clusterSize) * clustersY + (cells % height) // clusterSize
+        self._cluster = cluster.tolist()
+
+        # Aristas que cruzan de un cluster a otro (sus origenes son las salidas de cada cluster)
+        sources = np.repeat(cells, np.diff(compiledMap.indptr))
+        crossing = cluster[sources] != cluster[compiledMap.indices]
+        self._crossings = {}
+        for source, target, weight in zip(sources[crossing].tolist(), compiledMap.indices[crossing].tolist(),
+                                          compiledMap.weights[crossing].tolist()):
+            self._crossings.setdefault(source, []).append((target, weight))
+        self._exits = {}
+        for source in self._crossings:
+            self._exits.setdefault(self._cluster[source], []).append(source)
+
+        # Arboles de Dijkstra dentro del cluster (por celda) y siguiente punto de paso hacia cada destino
+        self._trees = {}
+        self._edges = {}
+        self._next = {}
+
+        self._destinationIndex = {self.cellId(pos): i for i, pos in enumerate(destinations)}
+        self._component, self._reach = self.reachability()
+
+        # Distancias exactas desde y hacia cada landmark (para la heuristica)
+        indptr, indices, weights = compiledMap.reverse()
+        reverse = (indptr.tolist(), indices.tolist(), weights.tolist())
+        forward = (self._indptr, self._indices, self._weights)
+        self.landmarks = self.choose_landmarks(numLandmarks)
+        self._fromLandmark = []
+        self._toLandmark = []
+        for landmark in self.landmarks:
+            for graph, distances in ((forward, self._fromLandmark), (reverse, self._toLandmark)):
+                distance = dijkstra(graph, landmark, numCells)[1]
+                distances.append([UNREACHABLE if d == float("inf") else d for d in distance])
+
+    def choose_landmarks(self, numLandmarks):
+        '''
+        Picks the cells of the graph closest to the corners of the map, and then to the middle of its sides.
+        '''
+        indptr = np.array(self._indptr)
+        cells = np.flatnonzero(np.diff(indptr) > 0)
+        if not cells.size:
+            return []
+        xs, ys = cells // self.height, cells % self.height
+        right, top = self.width - 1, self.height - 1
+        anchors = [(0, 0), (right, top), (0, top), (right, 0),
+                   (right // 2, 0), (right // 2, top), (0, top // 2), (right, top // 2)]
+
+        landmarks = []
+        for ax, ay in anchors[:numLandmarks]:
+            cell = int(cells[np.argmin(np.maximum(np.abs(xs - ax), np.abs(ys - ay)))])
+            if cell not in landmarks:
+                landmarks.append(cell)
+        return landmarks
+
+    def cellId(self, pos):
+        ''' Returns the index of a cell. '''
+        return pos[0] * self.height + pos[1]
+
+    def cellPos(self, cell):
+        ''' Returns the (x, y) position of a cell index. '''
+        return divmod(cell, self.height)
+
+    def reachability(self):
+        '''
+        Finds the strongly connected components of the lane graph (iterative Tarjan) and, for each one,
+        the destinations it can reach as a bit set (Tarjan finishes a component after every component
+        it reaches, so their sets are ready when it is finished).
+        Returns the component of every cell (-1 if the cell is not in the graph) and the bit sets.
+        '''
+        indptr, indices = self._indptr, self._indices
+        numCells = len(indptr) - 1
+        index = [-1] * numCells
+        low = [0] * numCells
+        component = [-1] * numCells
+        onStack = [False] * numCells
+        stack = []
+        reach = []
+        counter = 0
+
+        for root in range(numCells):
+            if index[root] >= 0 or indptr[root] == indptr[root + 1]:
+                continue
+
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            onStack[root] = True
+            work = [(root, indptr[root])]
+            while work:
+                cell, k = work[-1]
+                if k < indptr[cell + 1]:
+                    work[-1] = (cell, k + 1)
+                    neighbor = indices[k]
+                    if index[neighbor] < 0:
+                        index[neighbor] = low[neighbor] = counter
+                        counter += 1
+                        stack.append(neighbor)
+                        onStack[neighbor] = True
+                        work.append((neighbor, indptr[neighbor]))
+                    elif onStack[neighbor]:
+                        low[cell] = min(low[cell], index[neighbor])
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[cell])
+                if low[cell] != index[cell]:
+                    continue
+
+                # La celda es la raiz de un componente: sacarlo de la pila
+                members = []
+                while True:
+                    member = stack.pop()
+                    onStack[member] = False
+                    component[member] = len(reach)
+                    members.append(member)
+                    if member == cell:
+                        break
+
+                bits = 0
+                for member in members:
+                    if member in self._destinationIndex:
+                        bits |= 1 << self._destinationIndex[member]
+                    for k in range(indptr[member], indptr[member + 1]):
+                        other = component[indices[k]]
+                        if other != len(reach):
+                            bits |= reach[other]
+                reach.append(bits)
+
+        return component, reach
+
+    def reachable(self, source, destination):
+        ''' Whether the destination can be reached from the source. '''
+        if source == destination:
+            return True
+        component = self._component[self.cellId(source)]
+        return component >= 0 and bool(self._reach[component] >> self._destinationIndex[self.cellId(destination)] & 1)
+
+    def tree(self, source):
+        '''
+        Runs Dijkstra from the cell without leaving its cluster (kept for the next queries).
+        Returns the cost and the parent of every cell reached.
+        '''
+        if source in self._trees:
+            return self._trees[source]
+
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        cluster = self._cluster
+        home = cluster[source]
+        cost = {source: 0}
+        parent = {source: -1}
+        queue = [(0, source)]
+        while queue:
+            cellCost, cell = heapq.heappop(queue)
+            if cellCost > cost[cell]:
+                continue
+            for k in range(indptr[cell], indptr[cell + 1]):
+                neighbor = indices[k]
+                newCost = cellCost + weights[k]
+                if cluster[neighbor] == home and newCost < cost.get(neighbor, float("inf")):
+                    cost[neighbor] = newCost
+                    parent[neighbor] = cell
+                    heapq.heappush(queue, (newCost, neighbor))
+
+        self._trees[source] = (cost, parent)
+        return cost, parent
+
+    def edges(self, cell):
+        ''' Edges of the abstract graph that leave the cell: to the exits of its cluster and crossing to other clusters. '''
+        edges = self._edges.get(cell)
+        if edges is None:
+            treeCost = self.tree(cell)[0]
+            edges = [(other, treeCost[other]) for other in self._exits.get(self._cluster[cell], ())
+                     if other != cell and other in treeCost]
+            edges += self._crossings.get(cell, [])
+            self._edges[cell] = edges
+        return edges
+
+    def search(self, source, target):
+        '''
+        Runs A* over the abstract graph from the source cell to the target cell.
+        Remembers the next point of the path from each of its points, and returns whether there is a path.
+        '''
+        height = self.height
+        targetX, targetY = divmod(target, height)
+        targetCluster = self._cluster[target]
+        minWeight = self.minWeight
+        # Cota inferior por desigualdad del triangulo con cada landmark
+        bounds = [(toLandmark, toLandmark[target], fromLandmark, fromLandmark[target])
+                  for toLandmark, fromLandmark in zip(self._toLandmark, self._fromLandmark)]
+
+        def heuristic(cell):
+            x, y = divmod(cell, height)
+            bound = max(abs(x - targetX), abs(y - targetY)) * minWeight
+            for toLandmark, targetTo, fromLandmark, targetFrom in bounds:
+                bound = max(bound, toLandmark[cell] - targetTo, targetFrom - fromLandmark[cell])
+            return bound
+
+        # El contador desempata en orden de insercion
+        counter = count()
+        cost = {source: 0}
+        parent = {source: -1}
+        closed = set()
+        queue = [(heuristic(source), next(counter), source)]
+        while queue:
+            _, _, cell = heapq.heappop(queue)
+            if cell == target:
+                while cell != source:
+                    self._next[(parent[cell], target)] = cell
+                    cell = parent[cell]
+                return True
+
+            if cell in closed:
+                continue
+            closed.add(cell)
+
+            edges = self.edges(cell)
+            if self._cluster[cell] == targetCluster:
+                treeCost = self.tree(cell)[0]
+                if target in treeCost:
+                    edges = edges + [(target, treeCost[target])]
+
+            cellCost = cost[cell]
+            for neighbor, weight in edges:
+                newCost = cellCost + weight
+                if neighbor not in closed and newCost < cost.get(neighbor, float("inf")):
+                    cost[neighbor] = newCost
+                    parent[neighbor] = cell
+                    heapq.heappush(queue, (newCost + heuristic(neighbor), next(counter), neighbor))
+
+        return False
+
+    def segment(self, source, target):
+        ''' Cells from source (excluded) to the next point of its path (included). '''
+        if self._cluster[source] != self._cluster[target]:
+            return [target]
+
+        _, parent = self.tree(source)
+        cells = []
+        cell = target
+        while cell != source:
+            cells.append(cell)
+            cell = parent[cell]
+        cells.reverse()
+        return cells
+
+    def route(self, source, destination):
+        '''
+        Returns the path from source to destination (without the source) up to the first cell of the next
+        cluster, as a tuple, or an empty tuple if there is no path. The tuple is shared, so it must not be changed.
+        '''
+        cell = self.cellId(source)
+        key = (cell, destination)
+        route = self.routes.get(key)
+        if route is not None:
+            return route
+
+        target = self.cellId(destination)
+        path = []
+        if cell != target and self.reachable(source, destination) and \
+                ((cell, target) in self._next or self.search(cell, target)):
+            home = self._cluster[cell]
+            while cell != target and self._cluster[cell] == home:
+                nextCell = self._next[(cell, target)]
+                path += self.segment(cell, nextCell)
+                cell = nextCell
+
+        route = self.routes[key] = tuple(self.cellPos(cell) for cell in path)
+        return route
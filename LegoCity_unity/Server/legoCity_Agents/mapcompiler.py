@@ -0,0 +1,308 @@
+import hashlib
+import json
+import os
+import tempfile
+import networkx as nx
+import numpy as np
+
+# Codigos del tipo de celda (el agente estatico de cada celda)
+EMPTY = 0
+ROAD = 1
+TRAFFIC_LIGHT = 2
+OBSTACLE = 3
+DESTINATION = 4
+CAR_GENERATOR = 5
+
+# Codigos de direccion (-1 si la celda no tiene direccion)
+NO_DIRECTION = -1
+DIRECTIONS = ["Left", "Right", "Up", "Down", "Up-Left", "Up-Right", "Down-Left", "Down-Right", "destination", "CarGenerator"]
+DIRECTION_CODES = {direction: code for code, direction in enumerate(DIRECTIONS)}
+LEFT, RIGHT, UP, DOWN, UP_LEFT, UP_RIGHT, DOWN_LEFT, DOWN_RIGHT = range(8)
+
+# Caracteres del archivo de mapa
+ROAD_CHARACTERS = ["v", "^", ">", "<", "g", "h", "b", "n"]
+LIGHT_CHARACTERS = ["R", "r", "L", "l", "U", "u", "D", "d"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "city_files", "cache")
+
+# Cambiar si cambia la forma de construir el grafo (invalida los mapas guardados)
+COMPILER_VERSION = 1
+
+
+class CompiledMap:
+    """
+    Lane graph of a city map stored as flat arrays.
+    Cells are numbered x * height + y, and the edges are in CSR format: the successors of
+    a cell are indices[indptr[cell]:indptr[cell + 1]] with weights in the same positions.
+    Attributes:
+        width: Width of the map
+        height: Height of the map
+        cellType: Code of each cell (EMPTY, ROAD, TRAFFIC_LIGHT, ...), indexed by (x, y)
+        direction: Code of the direction of each cell (see DIRECTIONS), indexed by (x, y)
+        indptr: Start of the successors of each cell (length width * height + 1)
+        indices: Successor cells
+        weights: Weight of each edge (2 when the edge enters a traffic light, 1 otherwise)
+    """
+    def __init__(self, width, height, cellType, direction, indptr, indices, weights):
+        self.width = width
+        self.height = height
+        self.cellType = cellType
+        self.direction = direction
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+
+    @property
+    def numCells(self):
+        return self.width * self.height
+
+    def cellId(self, pos):
+        return pos[0] * self.height + pos[1]
+
+    def cellPos(self, cell):
+        return divmod(int(cell), self.height)
+
+    def successors(self, cell):
+        return self.indices[self.indptr[cell]:self.indptr[cell + 1]]
+
+    def reverse(self):
+        '''
+        Returns the predecessors in CSR format (indptr, indices, weights).
+        The predecessors of each cell stay ordered by their cell number.
+        '''
+        sources = np.repeat(np.arange(self.numCells, dtype=np.int32), np.diff(self.indptr))
+        order = np.argsort(self.indices, kind="stable")
+        indptr = np.zeros(self.numCells + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=self.numCells), out=indptr[1:])
+        return indptr, sources[order], self.weights[order]
+
+    def to_graph(self):
+        ''' Returns the lane graph as a NetworkX DiGraph (same nodes, edges and order as CityModel.create_graph). '''
+        DG = nx.DiGraph()
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        weights = self.weights.tolist()
+        for cell in range(self.numCells):
+            source = self.cellPos(cell)
+            for k in range(indptr[cell], indptr[cell + 1]):
+                DG.add_edge(source, self.cellPos(indices[k]), weight=weights[k])
+        return DG
+
+    def save(self, path):
+        # Escribir a un archivo temporal y renombrar, para no dejar un cache a medias
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".npz", delete=False) as output:
+            np.savez(output, width=self.width, height=self.height, cellType=self.cellType, direction=self.direction,
+                     indptr=self.indptr, indices=self.indices, weights=self.weights)
+        os.replace(output.name, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(int(data["width"]), int(data["height"]), data["cellType"], data["direction"],
+                       data["indptr"], data["indices"], data["weights"])
+
+
+def next_possible_steps(cellType, direction, pos):
+    '''
+    Returns a list of the possible steps from a road cell, following its direction.
+    cellType and direction are indexed as [x][y] (NumPy layers or nested lists).
+    '''
+    width, height = len(cellType), len(cellType[0])
+    x, y = pos
+
+    # obtener los posibles pasos (vecindad de Moore, en el mismo orden que MultiGrid.get_neighborhood)
+    possible_steps = [(x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                      if (dx or dy) and 0 <= x + dx < width and 0 <= y + dy < height]
+
+    # quitar los obstaculos
+    possible_steps = [step for step in possible_steps if cellType[step[0]][step[1]] != OBSTACLE]
+
+    cellDirection = direction[x][y]
+
+    if cellDirection == RIGHT:
+        # quitar las calles que estan atrás o alado del agente
+        possible_steps = [step for step in possible_steps if step[0] > x or cellType[step[0]][step[1]] == DESTINATION]
+
+        # quitar las calles que *vienen* hacia el agente
+        possible_steps = [step for step in possible_steps if not
+                               (step[1] > y and direction[step[0]][step[1]] == DOWN) and not
+                               (step[1] < y and direction[step[0]][step[1]] == UP)]
+
+    elif cellDirection == LEFT:
+        # quitar las calles que estan atrás o alado del agente
+        possible_steps = [step for step in possible_steps if step[0] < x]
+
+        # quitar las calles que *vienen* hacia el agente
+        possible_steps = [step for step in possible_steps if not
+                               (step[1] < y and direction[step[0]][step[1]] == UP) and not
+                               (step[1] > y and direction[step[0]][step[1]] == DOWN)]
+
+    elif cellDirection == UP:
+        # quitar las calles que estan atrás o alado del agente
+        possible_steps = [step for step in possible_steps if step[1] > y]
+
+        # quitar las calles que *vienen* hacia el agente
+        possible_steps = [step for step in possible_steps if not
+                               (step[0] < x and direction[step[0]][step[1]] == LEFT) and not
+                               (step[0] > x and direction[step[0]][step[1]] == RIGHT)]
+
+    elif cellDirection == DOWN:
+        # quitar las calles que estan atrás o alado del agente
+        possible_steps = [step for step in possible_steps if step[1] < y]
+
+        # quitar las calles que *vienen* hacia el agente
+        possible_steps = [step for step in possible_steps if not
+                               (step[0] < x and direction[step[0]][step[1]] == LEFT) and not
+                               (step[0] > x and direction[step[0]][step[1]] == RIGHT)]
+
+    # Aqui van las raritas
+    elif cellDirection == UP_LEFT:
+        possible_steps = [step for step in possible_steps if step[0] < x or step[1] > y]
+
+    elif cellDirection == UP_RIGHT:
+        possible_steps = [step for step in possible_steps if step[0] > x or step[1] > y]
+
+    elif cellDirection == DOWN_LEFT:
+        possible_steps = [step for step in possible_steps if step[0] < x or step[1] < y]
+
+    elif cellDirection == DOWN_RIGHT:
+        possible_steps = [step for step in possible_steps if step[1] <= y and step[0] >= x]
+
+    return possible_steps
+
+
+def parse_map(lines, dataDictionary):
+    '''
+    Returns the width, height and the cell type and direction layers of a map.
+    Row r, column c of the file is the cell (c, height - r - 1), like in CityModel.
+    '''
+    width = len(lines[0]) - 1
+    height = len(lines)
+    cellType = np.zeros((width, height), dtype=np.int8)
+    direction = np.full((width, height), NO_DIRECTION, dtype=np.int8)
+
+    for r, row in enumerate(lines):
+        for c, col in enumerate(row):
+            pos = (c, height - r - 1)
+            if col in ROAD_CHARACTERS:
+                cellType[pos], direction[pos] = ROAD, DIRECTION_CODES[dataDictionary[col]]
+            elif col in LIGHT_CHARACTERS:
+                cellType[pos], direction[pos] = TRAFFIC_LIGHT, DIRECTION_CODES[dataDictionary[col][1]]
+            elif col == "#":
+                cellType[pos] = OBSTACLE
+            elif col == "T":
+                cellType[pos], direction[pos] = DESTINATION, DIRECTION_CODES["destination"]
+            elif col == "C":
+                cellType[pos], direction[pos] = CAR_GENERATOR, DIRECTION_CODES[dataDictionary[col][1]]
+
+    return width, height, cellType, direction
+
+
+def build_csr(width, height, cellType, direction):
+    ''' Builds the lane graph in CSR format from the cell type and direction layers. '''
+    cellTypes = cellType.tolist()
+    directions = direction.tolist()
+
+    indptr = [0]
+    indices = []
+    weights = []
+    # Recorrer todo el grid (mismo orden que create_graph)
+    for i in range(width):
+        for j in range(height):
+            if cellTypes[i][j] in (ROAD, TRAFFIC_LIGHT, CAR_GENERATOR):
+                for step in next_possible_steps(cellTypes, directions, (i, j)):
+                    indices.append(step[0] * height + step[1])
+                    # Super cheap forma de hacer que no vayan y se crucen a otro semaforo (posible mejora)
+                    weights.append(2 if cellTypes[step[0]][step[1]] == TRAFFIC_LIGHT else 1)
+            indptr.append(len(indices))
+
+    return (np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32),
+            np.array(weights, dtype=np.int32))
+
+
+def light_clusters(cellType):
+    '''
+    Groups the traffic light cells into 8-connected clusters (the lights of one intersection).
+    Returns a list of clusters, each a list of positions, ordered by their first cell.
+    '''
+    lights = set(map(tuple, np.argwhere(cellType == TRAFFIC_LIGHT).tolist()))
+    clusters = []
+    for start in sorted(lights):
+        if start not in lights:
+            continue
+        lights.discard(start)
+        cluster = [start]
+        pending = [start]
+        while pending:
+            x, y = pending.pop()
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbor = (x + dx, y + dy)
+                    if neighbor in lights:
+                        lights.discard(neighbor)
+                        cluster.append(neighbor)
+                        pending.append(neighbor)
+        clusters.append(sorted(cluster))
+    return clusters
+
+
+def unreachable_generators(compiledMap):
+    '''
+    Returns the positions of the car generators that can't reach any destination.
+    Runs a single search backwards from every destination over the predecessors.
+    '''
+    indptr, indices, _ = compiledMap.reverse()
+    indptr, indices = indptr.tolist(), indices.tolist()
+    cellTypes = compiledMap.cellType.ravel()
+
+    reached = [False] * compiledMap.numCells
+    pending = np.flatnonzero(cellTypes == DESTINATION).tolist()
+    for cell in pending:
+        reached[cell] = True
+    while pending:
+        cell = pending.pop()
+        for k in range(indptr[cell], indptr[cell + 1]):
+            predecessor = indices[k]
+            if not reached[predecessor]:
+                reached[predecessor] = True
+                pending.append(predecessor)
+
+    return [compiledMap.cellPos(cell) for cell in np.flatnonzero(cellTypes == CAR_GENERATOR).tolist() if not reached[cell]]
+
+
+def map_hash(lines, dataDictionary):
+    ''' Hash of the contents of the map and the dictionary (the key of the cache). '''
+    digest = hashlib.sha256()
+    digest.update(f"v{COMPILER_VERSION}\n".encode())
+    digest.update("".join(lines).encode())
+    digest.update(json.dumps(dataDictionary, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def compile_map(lines, dataDictionary, cacheDir = DEFAULT_CACHE_DIR):
+    '''
+    Compiles the map (its lines) with the dictionary into a CompiledMap.
+    If cacheDir is given, the result is stored there keyed by the hash of the map and
+    dictionary contents, and later compilations of the same contents are read from disk.
+    '''
+    path = None
+    if cacheDir:
+        path = os.path.join(cacheDir, map_hash(lines, dataDictionary) + ".npz")
+        if os.path.exists(path):
+            try:
+                return CompiledMap.load(path)
+            except (OSError, ValueError, KeyError):
+                pass
+
+    width, height, cellType, direction = parse_map(lines, dataDictionary)
+    compiled = CompiledMap(width, height, cellType, direction, *build_csr(width, height, cellType, direction))
+
+    if path:
+        try:
+            compiled.save(path)
+        except OSError:
+            # Si no se puede escribir el cache, solo se pierde la aceleracion
+            pass
+    return compiled
@@ -0,0 +1,101 @@
+from time import perf_counter
+
+
+class StepMetrics:
+    """
+    Timers and counters for the phases of CityModel.step.
+    Timers are inclusive: a phase timed inside another one also counts in the outer one.
+    Attributes:
+        enabled: Whether timers and counters are recorded
+        steps: Number of finished steps
+        times: Dictionary phase -> total seconds
+        calls: Dictionary phase -> number of timed calls
+        counters: Dictionary name -> total count
+        lastStepTimes: Seconds of each phase during the last finished step
+        lastStepCounters: Counters of the last finished step
+    """
+    def __init__(self, enabled = True, counters = ()):
+        """
+        Creates the metrics.
+        Args:
+            enabled: Whether timers and counters are recorded
+            counters: Names of the counters that should always be reported (even if they stay in 0)
+        """
+        self.enabled = enabled
+        self.steps = 0
+        self.times = {}
+        self.calls = {}
+        self.counters = {name: 0 for name in counters}
+        self.lastStepTimes = {}
+        self.lastStepCounters = dict(self.counters)
+
+        self._stepTimes = {}
+        self._stepCounters = dict(self.counters)
+
+    def timer(self, phase):
+        ''' Context manager that adds the time spent inside it to the phase. '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, phase)
+
+    def add_time(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        self._stepTimes[phase] = self._stepTimes.get(phase, 0) + seconds
+
+    def count(self, name, amount = 1):
+        ''' Increments a counter. '''
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + amount
+        self._stepCounters[name] = self._stepCounters.get(name, 0) + amount
+
+    def end_step(self):
+        ''' Closes the current step, so its values are available in lastStepTimes and lastStepCounters. '''
+        self.steps += 1
+        self.lastStepTimes = self._stepTimes
+        self.lastStepCounters = self._stepCounters
+        self._stepTimes = {}
+        self._stepCounters = {name: 0 for name in self.counters}
+
+    def summary(self):
+        ''' Returns every metric as a JSON serializable dictionary. '''
+        return {
+            "steps": self.steps,
+            "totalTimes": dict(self.times),
+            "meanTimesPerStep": {phase: total / self.steps for phase, total in self.times.items()} if self.steps else {},
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+            "countersPerStep": {name: total / self.steps for name, total in self.counters.items()} if self.steps else {},
+            "lastStepTimes": dict(self.lastStepTimes),
+            "lastStepCounters": dict(self.lastStepCounters),
+        }
+
+
+class _Timer:
+    __slots__ = ("metrics", "phase", "start")
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.phase, perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
@@ -1,40 +1,125 @@
 from mesa import Model, DataCollector
 from mesa.time import RandomActivation
-from mesa.space import MultiGrid
 from legoCity_Agents.agent import *
+from legoCity_Agents.delta import StepDelta
+from legoCity_Agents.fleet import FleetActivation
+from legoCity_Agents.hierarchy import HierarchicalRouter
+from legoCity_Agents.mapcompiler import compile_map, light_clusters, next_possible_steps, DEFAULT_CACHE_DIR
+from legoCity_Agents.metrics import StepMetrics
+from legoCity_Agents.parallel import TiledActivation
+from legoCity_Agents.pathfinding import PathFinder
+from legoCity_Agents.reservation import CooperativePlanner
+from legoCity_Agents.routing import RouteTable
+from legoCity_Agents.space import *
+from collections import deque
 import json
-import networkx as nx
+import os
+import numpy as np
 # import requests
 
+CITY_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "city_files")
+DEFAULT_MAP = os.path.join(CITY_FILES, "base_city_2023.txt")
+DEFAULT_DICTIONARY = os.path.join(CITY_FILES, "mapDictionary.json")
+
 class CityModel(Model):
     """ 
         Creates a model based on a city map.
     """
-    def __init__(self):
-        # Cargar el diccionario del mapa. El diccionario asigna los caracteres del archivo de mapa al agente correspondiente.
-        dataDictionary = json.load(open("legoCity_Agents/city_files/mapDictionary.json"))
+    def __init__(self, mapFile = DEFAULT_MAP, dictionaryFile = DEFAULT_DICTIONARY, carGeneratorTime = None,
+                 trafficLightTimes = None, maxSteps = 1000, verbose = True, collectMetrics = True, deltaHistory = 100,
+                 seed = None, cacheDir = DEFAULT_CACHE_DIR, signalTimings = None, intersectionControl = "independent",
+                 maxGreenExtension = 5, tileSize = None, workers = None, vectorized = False,
+                 reservationWindow = None, clusterSize = None, stopOnCollision = True):
+        """
+        Creates a new city model.
+        Args:
+            mapFile: Text file where each character represents an agent
+            dictionaryFile: JSON file that maps the characters of the map to the agents
+            carGeneratorTime: Steps between each car generated (overrides the "C" entry of the dictionary)
+            trafficLightTimes: Dictionary character -> steps between each change of those traffic lights (overrides the dictionary)
+            maxSteps: Step after which the model stops running
+            verbose: Whether to print each step
+            collectMetrics: Whether to time each phase of the step (see self.metrics)
+            deltaHistory: Number of steps whose changes are kept for changesSince
+            seed: Seed of the model's random number generator (must be passed as keyword)
+            cacheDir: Directory where the compiled maps are cached (None to always compile the map)
+            signalTimings: List with a (timeToChange, offset) pair, or None to keep the dictionary times, for each intersection (see set_signal_timings)
+            intersectionControl: "independent" (each traffic light is scheduled), "grouped" or "actuated" (one Intersection agent per intersection)
+            maxGreenExtension: Maximum steps the actuated intersections can extend a green
+            tileSize: If given, the cars are planned by tiles of this size in worker processes (see TiledActivation)
+            workers: Worker processes of the tiled scheduler (0 plans the tiles in this process)
+            vectorized: Whether all the cars are stepped at once with NumPy (see FleetActivation)
+            reservationWindow: If given, the cars plan this many steps at a time around the cells reserved by
+                               the other cars (see CooperativePlanner). Only with the default scheduler
+            clusterSize: If given, the routes are found on clusters of this size (see HierarchicalRouter) instead of
+                         precomputing a route table to every destination, which is too slow and large for big maps
+            stopOnCollision: Whether the model stops running when two cars collide (the benchmarks keep stepping)
+        """
+        super().__init__()
+        if reservationWindow is not None and (tileSize or vectorized):
+            raise ValueError("reservationWindow can only be used with the default scheduler")
+        if reservationWindow is not None and clusterSize:
+            raise ValueError("reservationWindow needs the route table (it can't be used with clusterSize)")
+
+        # Toda la aleatoriedad (orden de activacion y destinos) sale de self.random
+        self.reset_randomizer(seed)
 
+        # Cargar el diccionario del mapa. El diccionario asigna los caracteres del archivo de mapa al agente correspondiente.
+        with open(dictionaryFile) as dictionary:
+            dataDictionary = json.load(dictionary)
+
+        # Tiempos configurables (para los barridos de parametros)
+        if carGeneratorTime is not None:
+            dataDictionary["C"] = [carGeneratorTime, dataDictionary["C"][1]]
+        if trafficLightTimes:
+            for character, timeToChange in trafficLightTimes.items():
+                dataDictionary[character] = [timeToChange, dataDictionary[character][1]]
+
+        self.mapFile = mapFile
+        self.maxSteps = maxSteps
+        self.stopOnCollision = stopOnCollision
+        self.clusterSize = clusterSize
+        self.verbose = verbose
         self.traffic_lights = []
 
+        # Agentes que no cambian despues de crear el modelo (se serializan una sola vez)
+        self.staticWorld = {"roads": [], "obstacles": [], "destinations": []}
+
+        # Tiempos por fase y contadores (ninguna ruta copia el grafo desde el overlay de pesos, graph_copies queda en 0)
+        self.metrics = StepMetrics(collectMetrics, counters = ["astar_calls", "route_lookups", "graph_copies",
+                                                                     "cooperative_plans"])
+
+        # Cambios de cada step (coches generados, movidos, que llegaron y semaforos que cambiaron)
+        self.delta = StepDelta()
+        self.deltaHistory = deque(maxlen = deltaHistory)
+
         # Cargue el archivo del mapa. El archivo de mapa es un archivo de texto donde cada personaje representa un agente.
-        with open('legoCity_Agents/city_files/base_city_2023.txt') as baseFile:
+        with open(mapFile) as baseFile:
             lines = baseFile.readlines()
             self.width = len(lines[0])-1
             self.height = len(lines)
             self.numCars = 0
             self.destinationsList = []
             self.arrivedCarsList = []
+            # Carros que llegaron durante el step actual (se publican en el siguiente)
+            self.pendingArrivals = []
 
             # Numero de carros que han llegado a su destino (para la competencia)
             self.numArrivedCars = 0
 
-            self.grid = MultiGrid(self.width, self.height, torus = False) 
-            self.schedule = RandomActivation(self)
+            self.grid = CityGrid(self.width, self.height, torus = False) 
+            if tileSize:
+                self.schedule = TiledActivation(self, tileSize, workers)
+            elif vectorized:
+                self.schedule = FleetActivation(self)
+            else:
+                self.schedule = RandomActivation(self)
 
             # Detección de coliciones 
             self.datacollector = DataCollector( 
                 model_reporters = {
                         "Car collision": lambda m: 1 if m.checkCollision() else 0,
+                        "Collision cells": lambda m: m.checkCollision(),
             })
 
             # Revisa cada personaje en el archivo de mapa y crea el agente correspondiente.
@@ -45,29 +130,58 @@ class CityModel(Model):
                     if col in ["v", "^", ">", "<", "g","h","b","n"]:
                         agent = Road(f"r_{r*self.width+c}", self, dataDictionary[col])
                         self.grid.place_agent(agent, (c, self.height - r - 1))
+                        self.staticWorld["roads"].append(agent)
 
                     elif col in ["R","r","L","l","U","u","D","d"]:
                         agent = Traffic_Light(f"tl_{r*self.width+c}", self, False if col in ["R","L","U","D"] else True, dataDictionary[col])
                         self.grid.place_agent(agent, (c, self.height - r - 1))
+                        self.staticWorld["roads"].append(agent)
                         self.schedule.add(agent)
                         self.traffic_lights.append(agent)
 
                     elif col == "#":
                         agent = Obstacle(f"ob_{r*self.width+c}", self)
                         self.grid.place_agent(agent, (c, self.height - r - 1))
+                        self.staticWorld["obstacles"].append(agent)
 
                     elif col == "T":
                         agent = Destination(f"d_{r*self.width+c}", self)
                         self.grid.place_agent(agent, (c, self.height - r - 1))
+                        self.staticWorld["destinations"].append(agent)
                         self.destinationsList.append(agent)
 
                     elif col == "C":
                         agent = Car_Generator(f"cg_{r*self.width+c}", self, dataDictionary[col])
                         self.grid.place_agent(agent, (c, self.height - r - 1))
+                        self.staticWorld["roads"].append(agent)
                         self.schedule.add(agent)
 
-        # Crear el grafo para sacar las rutas mas cortas para cada agente
-        self.graph = self.create_graph()
+        # Compilar el mapa a un grafo en arreglos (CSR), o leerlo del cache si el mapa y el diccionario no cambiaron
+        self.compiledMap = compile_map(lines, dataDictionary, cacheDir)
+
+        # Semaforos de cada interseccion (grupos de semaforos vecinos, incluyendo diagonales)
+        self.intersections = self.create_intersections(intersectionControl, maxGreenExtension)
+        if signalTimings:
+            self.set_signal_timings(signalTimings)
+
+        # El grafo de NetworkX se crea hasta que se pide (ninguna ruta lo usa)
+        self._graph = None
+
+        # Tabla de rutas precalculada hacia cada destino (el grafo no cambia), o rutas por clusters en mapas grandes
+        destinations = [d.pos for d in self.destinationsList]
+        if clusterSize:
+            self.routeTable = HierarchicalRouter(self.compiledMap, destinations, clusterSize)
+        else:
+            self.routeTable = RouteTable(self.compiledMap, destinations)
+
+        # A* sobre los arreglos del mapa compilado (para las rutas con pesos temporales, como changeLane)
+        self.pathFinder = PathFinder(self.compiledMap)
+
+        # Reservaciones espacio-tiempo de las celdas (solo si se pidieron)
+        self.planner = None
+        if reservationWindow:
+            generators = [tuple(pos) for pos in np.argwhere(self.compiledMap.cellType == CAR_GENERATOR).tolist()]
+            self.planner = CooperativePlanner(self.pathFinder, self.routeTable, reservationWindow, generators)
         # print(self.graph.edges())
         # path = nx.astar_path(self.graph, (0,0), (19,1), weight='weight')
         # print(path)
@@ -76,148 +190,166 @@ class CityModel(Model):
 
     def step(self):
         '''Advance the model by one step.'''
-        print(f"Step: {self.schedule.steps}")
-        self.deleteCars()
-        self.schedule.step()
-        self.datacollector.collect(self)
+        if self.verbose:
+            print(f"Step: {self.schedule.steps}")
+        self.delta = StepDelta()
+        with self.metrics.timer("step"):
+            with self.metrics.timer("deleteCars"):
+                self.deleteCars()
+            if self.planner is not None:
+                self.planner.table.expire(self.schedule.steps)
+            with self.metrics.timer("schedule"):
+                self.schedule.step()
+            with self.metrics.timer("collect"):
+                self.datacollector.collect(self)
+        self.metrics.end_step()
+        self.deltaHistory.append((self.schedule.steps, self.delta))
 
         # if self.schedule.steps % 100 == 0:
         #     self.concurso()
 
-        # Parar en el step 1000
-        if self.schedule.steps == 1001:
+        # Parar en el step maxSteps (1000 por defecto)
+        if self.schedule.steps == self.maxSteps + 1:
             self.running = False
 
+        # Sin mas steps, los procesos del scheduler ya no se necesitan
+        if not self.running:
+            self.close()
+
+    def close(self):
+        '''
+        Releases what the model keeps running outside of Python objects (the worker processes of TiledActivation).
+        The model can still step after it: the workers start again on the next step.
+        '''
+        if isinstance(self.schedule, TiledActivation):
+            self.schedule.close()
+
     
+    def set_signal_timings(self, signalTimings):
+        '''
+        Sets the timing of the traffic lights of each intersection (same order as self.intersections).
+        Every light of an intersection changes every timeToChange steps, on the steps where
+        (step - offset) % timeToChange == 0, so the lights keep the opposite states they start with.
+        A None entry keeps the times of the dictionary for that intersection.
+        '''
+        if len(signalTimings) != len(self.intersections):
+            raise ValueError(f"Expected {len(self.intersections)} signal timings, got {len(signalTimings)}")
+
+        for intersection, timing in zip(self.intersections, signalTimings):
+            if timing is None:
+                continue
+            timeToChange, offset = timing
+            if timeToChange < 1:
+                raise ValueError(f"Invalid time to change: {timeToChange}")
+            intersection.set_timing(timeToChange, offset)
+
+    def create_intersections(self, mode, maxExtension):
+        '''
+        Creates an Intersection for every cluster of neighbouring traffic lights.
+        In the "grouped" and "actuated" modes the Intersection replaces its lights in the schedule.
+        '''
+        if mode not in ("independent", "grouped", "actuated"):
+            raise ValueError(f"Unknown intersection control: {mode}")
+
+        compiledMap = self.compiledMap
+        indptr, indices, _ = compiledMap.reverse()
+
+        intersections = []
+        for i, cluster in enumerate(light_clusters(compiledMap.cellType)):
+            lights = [self.grid.trafficLightAt(pos) for pos in cluster]
+
+            # Cada semaforo ve su celda y las celdas (que no son semaforos) que entran a ella
+            approaches = {}
+            for pos, light in zip(cluster, lights):
+                cell = compiledMap.cellId(pos)
+                predecessors = (compiledMap.cellPos(p) for p in indices[indptr[cell]:indptr[cell + 1]])
+                approaches[light] = [pos] + [p for p in predecessors if compiledMap.cellType[p] != TRAFFIC_LIGHT]
+
+            intersection = Intersection(f"i_{i}", self, lights, approaches, mode, maxExtension)
+            if mode != "independent":
+                for light in lights:
+                    self.schedule.remove(light)
+                self.schedule.add(intersection)
+            intersections.append(intersection)
+
+        return intersections
+
     def get_nextPossibleSteps(self, agent):
         ''' 
         Returns a list of the possible steps from the current position.
         '''
-        # obtener los posibles pasos
-        possible_steps = self.grid.get_neighborhood(
-            agent.pos,
-            moore=True, # includes diagonals
-        )
-
-        # quitar los obstaculos
-        possible_steps = [step for step in possible_steps 
-                          if not isinstance(self.grid[step[0]][step[1]][0], Obstacle)]
-        
-        if agent.direction == "Right":
-            # quitar las calles que estan atrás o alado del agente
-            possible_steps = [step for step in possible_steps if step[0] > agent.pos[0] or self.grid[step[0]][step[1]][0].direction  == "destination"]
-
-            # quitar las calles que *vienen* hacia el agente
-            possible_steps = [step for step in possible_steps if not 
-                                   (step[1] > agent.pos[1] and self.grid[step[0]][step[1]][0].direction in ["Down", "Destination"]) and not
-                                   (step[1] < agent.pos[1] and self.grid[step[0]][step[1]][0].direction in ["Up", "Destination"])]
-            
-        elif agent.direction == "Left":
-            # quitar las calles que estan atrás o alado del agente
-            possible_steps = [step for step in possible_steps if step[0] < agent.pos[0]] # Le quito los de atras
-
-            # quitar las calles que *vienen* hacia el agente
-            possible_steps = [step for step in possible_steps if not 
-                                   (step[1] < agent.pos[1] and self.grid[step[0]][step[1]][0].direction in ["Up", "Destination"]) and not
-                                   (step[1] > agent.pos[1] and self.grid[step[0]][step[1]][0].direction in ["Down", "Destination"])]
-            
-        elif agent.direction == "Up":
-            # quitar las calles que estan atrás o alado del agente
-            possible_steps = [step for step in possible_steps if step[1] > agent.pos[1]]
-
-            # quitar las calles que *vienen* hacia el agente
-            possible_steps = [step for step in possible_steps if not 
-                                   (step[0] < agent.pos[0] and self.grid[step[0]][step[1]][0].direction in ["Left", "Destination"]) and not
-                                   (step[0] > agent.pos[0] and self.grid[step[0]][step[1]][0].direction in ["Right", "Destination"])]
-            
-        elif agent.direction == "Down":
-            # quitar las calles que estan atrás o alado del agente
-            possible_steps = [step for step in possible_steps if step[1] < agent.pos[1]]
-
-            # quitar las calles que *vienen* hacia el agente
-            possible_steps = [step for step in possible_steps if not 
-                                   (step[0] < agent.pos[0] and self.grid[step[0]][step[1]][0].direction in ["Left", "Destination"]) and not
-                                   (step[0] > agent.pos[0] and self.grid[step[0]][step[1]][0].direction in ["Right", "Destination"])]
-        
-        # Aqui van las raritas
-        elif agent.direction == "Up-Left":
-            # quitar las calles que estan atrás o alado del agente
-            possible_steps = [step for step in possible_steps if (step[0] < agent.pos[0] or (step[1] > agent.pos[1]))]
-            
-        elif agent.direction == "Up-Right":
-            # quitar las calles que estan atrás o alado del agente
-            possible_steps = [step for step in possible_steps if (step[0] > agent.pos[0] or (step[1] > agent.pos[1]))]
-            
-        elif agent.direction == "Down-Left":
-            # quitar las calles que estan atrás o alado del agente
-            possible_steps = [step for step in possible_steps if (step[0] < agent.pos[0] or (step[1] < agent.pos[1]))]
-            
-        elif agent.direction == "Down-Right":
-            # quitar las calles que estan atrás o alado del agente
-            # possible_steps = [step for step in possible_steps if (step[0] > agent.pos[0] or (step[1] < agent.pos[1]))]
-            possible_steps = [step for step in possible_steps if step[1] <= agent.pos[1]]
-            possible_steps = [step for step in possible_steps if step[0] >= agent.pos[0]]
-        
-        return possible_steps
+        return next_possible_steps(self.grid.cellType, self.grid.direction, agent.pos)
             
     
+    @property
+    def graph(self):
+        ''' Graph of the roads of the city (NetworkX), created the first time it is used. '''
+        if self._graph is None:
+            self._graph = self.create_graph()
+        return self._graph
+
     def create_graph(self):
-        ''' Creates a graph of the roads of the city map. '''
-        DG = nx.DiGraph()
-        # Recorrer todo el grid
-        for i in range(self.width):
-            for j in range(self.height):
-                # Si encuentra algo que no sea un obstaculo
-                if isinstance(self.grid[i][j][0], (Road, Traffic_Light, Car_Generator)):
-                    # Obtener sus posibles siguientes pasos (direccion de la calle)
-                    possibleSteps = self.get_nextPossibleSteps(self.grid[i][j][0])
-                    # Por si regresa algo vacio
-                    if possibleSteps:
-                        for step in possibleSteps:
-                            # Super cheap forma de hacer que no vayan y se crucen a otro semaforo (posible mejora)
-                            if isinstance(self.grid[step[0]][step[1]][0], Traffic_Light):
-                                DG.add_edge((i,j), step, weight=2)
-                            else:
-                                DG.add_edge((i,j), step, weight=1)
-        return DG
+        ''' Creates a graph of the roads of the city map (from the compiled map). '''
+        return self.compiledMap.to_graph()
     
     def deleteCars(self):
-        # Si la lista tiene mas de 0 elementos
+        '''
+        Removes the cars that arrived in the previous step, and publishes the ones that arrived in the last one
+        (they are removed in the next step). The cost depends only on the number of arrived cars.
+        '''
         if self.arrivedCarsList:
-            # Eliminar los carros de la lista
-            for i in self.arrivedCarsList:
-                # Incrementar el recuento de carros que llegaron a su destino
-                self.numArrivedCars += 1
-
-                # Quitar carros
-                self.grid.remove_agent(i)
-                self.schedule.remove(i)
-            
-            # Limpiar la lista
-            self.arrivedCarsList = []
+            # Incrementar el recuento de carros que llegaron a su destino
+            self.numArrivedCars += len(self.arrivedCarsList)
+            self.removeCars(self.arrivedCarsList)
+
+        # Los carros que llegaron a su destino (registrados por carArrived al moverse)
+        self.arrivedCarsList = self.pendingArrivals
+        self.pendingArrivals = []
+
+        for car in self.arrivedCarsList:
+            self.delta.car_arrived(car)
+
+    def carArrived(self, car):
+        ''' Registers a car that just moved to its destination (the next step publishes it). '''
+        self.pendingArrivals.append(car)
+        if self.planner is not None:
+            self.planner.table.release(car.unique_id)
+
+    def removeCars(self, cars):
+        ''' Removes the cars from the grid and the schedule, all in one call. '''
+        grid = self.grid
+        schedule = self.schedule
+        for car in cars:
+            grid.remove_agent(car)
+            # El schedule guarda los agentes en un dict: quitar uno es O(1)
+            schedule.remove(car)
+
+    def changesSince(self, step):
+        '''
+        Returns the changes of every step after the given one merged in a single StepDelta,
+        or None if they are older than the history that is kept.
+        '''
+        if step >= self.schedule.steps:
+            return StepDelta()
+        if not self.deltaHistory or self.deltaHistory[0][0] > step + 1:
+            return None
 
-        # Agregar a la lista los carros que ya llegaron a su destino (para que el siguiente step los elimine)
-        for destination in self.destinationsList:
-            for agent in  self.grid[destination.pos[0]][destination.pos[1]]:
-                # Si hay un coche en uno de mis posibles destinos
-                if isinstance(agent, Car):
-                    self.arrivedCarsList.append(agent)
+        changes = StepDelta()
+        for deltaStep, delta in self.deltaHistory:
+            if deltaStep > step:
+                changes.merge(delta)
+        return changes
 
     def checkCollision(self):
-        # Recorre todo el grid para ver si existe el caso de que hayan 3 o mas agentes en una misma posicion (significando que alguien chocó)
-        for i in range(self.width):
-            for j in range(self.height):
-                if len(self.grid[i][j]) >= 3:
-                    for x in self.grid[i][j]:
-                        if isinstance(x, Destination):
-                            return False
-                    print("---------------------")
-                    print(f"Colition at: ({i}, {j})")
-                    for x in self.grid[i][j]:
-                        if not isinstance(x, Road):
-                            print(x.unique_id)
-                    self.running = False
-                    return True
+        ''' 
+        Returns every cell where two or more cars are at the same position (meaning someone crashed), destinations excluded.
+        The grid keeps these cells up to date as the cars move, so there is no need to scan it.
+        The model stops running on a collision, unless it was created with stopOnCollision = False.
+        '''
+        collisions = sorted(self.grid.collisions)
+        if collisions and self.stopOnCollision:
+            self.running = False
+        return collisions
 
 
     # def concurso(self):
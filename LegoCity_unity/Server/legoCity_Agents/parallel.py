@@ -0,0 +1,158 @@
+from concurrent.futures import ProcessPoolExecutor
+from legoCity_Agents.hierarchy import HierarchicalRouter
+from legoCity_Agents.pathfinding import PathFinder, lane_change_path
+from legoCity_Agents.routing import RouteTable
+from legoCity_Agents.scheduling import CarPhaseActivation
+import multiprocessing
+import numpy as np
+
+# Celdas alrededor de cada cuadrante que ve el worker (changeLane revisa hasta dos pasos adelante)
+HALO = 2
+
+# Estado de cada proceso worker (se crea una vez en _init_worker)
+_routeTable = None
+_pathFinder = None
+
+
+def _init_worker(compiledMap, destinations, clusterSize = None):
+    global _routeTable, _pathFinder
+    _routeTable = HierarchicalRouter(compiledMap, destinations, clusterSize) if clusterSize else RouteTable(compiledMap, destinations)
+    _pathFinder = PathFinder(compiledMap)
+
+
+def _plan_tile(task, routeTable = None, pathFinder = None):
+    '''
+    Decides the next move of the cars of one tile (runs in a worker, with its route table and path finder).
+    task is (cars, origin, occupied, lights): cars are (key, pos, next cell or None, path length, last cell of the path, destination),
+    and occupied and lights (-1 no light, 0 red, 1 green) are the layers of the tile and its halo starting at origin.
+    Returns, for each car, (key, new path or None if it didn't change, whether it wants to move), and the counters.
+    '''
+    cars, (ox, oy), occupied, lights = task
+    routeTable = routeTable or _routeTable
+    pathFinder = pathFinder or _pathFinder
+    width, height = occupied.shape
+
+    def hasCar(pos):
+        x, y = pos[0] - ox, pos[1] - oy
+        return 0 <= x < width and 0 <= y < height and bool(occupied[x, y])
+
+    plans = []
+    routeLookups = 0
+    astarCalls = 0
+    for key, pos, nextCell, pathLength, pathEnd, destination in cars:
+        newPath = None
+        if nextCell is None:
+            newPath = routeTable.route(pos, destination)
+            routeLookups += 1
+            if not newPath:
+                plans.append((key, newPath, False))
+                continue
+            nextCell, pathLength, pathEnd = newPath[0], len(newPath), newPath[-1]
+
+        # Misma logica que Car.canMove, sobre el estado al inicio de la fase de los coches
+        light = lights[pos[0] - ox, pos[1] - oy]
+        if light >= 0:
+            wantsMove = bool(light)
+        elif hasCar(nextCell) and pathLength >= 5:
+            newPath = lane_change_path(pathFinder, hasCar, pos, pathEnd)
+            astarCalls += 1
+            wantsMove = bool(newPath)
+        else:
+            wantsMove = True
+
+        plans.append((key, newPath, wantsMove))
+    return plans, routeLookups, astarCalls
+
+
+class TiledActivation(CarPhaseActivation):
+    """
+    Scheduler that splits the grid into square tiles and plans the moves of each tile's cars
+    in worker processes (route lookups and lane changes), then applies them in the main process.
+    Each step:
+        1. The agents that are not cars (traffic lights, intersections, car generators) step in random order.
+        2. Every tile is planned in parallel from the same snapshot of the car occupancy and the traffic lights.
+        3. The moves are applied in random order. A car only moves if its next cell is free at that
+           moment, so moves that cross tile borders can't end in the same cell, and a car can follow
+           one that moved earlier in the step (like with RandomActivation).
+    The cars still move with Grid.move_agent, so checkCollision keeps the same semantics.
+    Attributes:
+        tileSize: Side of each tile (cells)
+        workers: Number of worker processes (0 plans every tile in the main process)
+    """
+    def __init__(self, model, tileSize = 64, workers = None):
+        super().__init__(model)
+        self.tileSize = tileSize
+        self.workers = workers
+        self._executor = None
+
+    def start(self):
+        ''' Starts the workers (done on the first step, once the map and its routes exist). '''
+        destinations = [d.pos for d in self.model.destinationsList]
+        # spawn para no copiar los hilos del servidor con fork
+        self._executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = multiprocessing.get_context("spawn"),
+                                             initializer = _init_worker,
+                                             initargs = (self.model.compiledMap, destinations, self.model.clusterSize))
+
+    def close(self):
+        ''' Stops the workers. '''
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures = True)
+            self._executor = None
+
+    def tasks(self, cars):
+        ''' Groups the cars by tile and cuts the occupancy and traffic light layers of each tile. '''
+        grid = self.model.grid
+        occupied = grid.carCount > 0
+
+        lights = np.full((grid.width, grid.height), -1, dtype = np.int8)
+        if grid.trafficLights:
+            positions = np.array([light.pos for light in grid.trafficLights])
+            lights[positions[:, 0], positions[:, 1]] = [light.state for light in grid.trafficLights]
+
+        self.extend_routes(cars)
+        tiles = {}
+        for key, car in enumerate(cars):
+            tiles.setdefault((car.pos[0] // self.tileSize, car.pos[1] // self.tileSize), []).append(
+                (key, car.pos, car.nextCell(), car.remaining(), car.route[-1] if car.route else None,
+                 car.destinationAgent.pos))
+
+        tasks = []
+        for (tx, ty), tileCars in tiles.items():
+            x0, y0 = max(tx * self.tileSize - HALO, 0), max(ty * self.tileSize - HALO, 0)
+            x1, y1 = (tx + 1) * self.tileSize + HALO, (ty + 1) * self.tileSize + HALO
+            tasks.append((tileCars, (x0, y0), occupied[x0:x1, y0:y1], lights[x0:x1, y0:y1]))
+        return tasks
+
+    def step(self):
+        if self._executor is None and self.workers != 0:
+            self.start()
+        super().step()
+
+    def step_cars(self, cars):
+        model = self.model
+        with model.metrics.timer("TiledActivation.plan"):
+            tasks = self.tasks(cars)
+            if self._executor is None:
+                results = (_plan_tile(task, model.routeTable, model.pathFinder) for task in tasks)
+            else:
+                results = self._executor.map(_plan_tile, tasks)
+
+            plans = [None] * len(cars)
+            for tilePlans, routeLookups, astarCalls in results:
+                model.metrics.count("route_lookups", routeLookups)
+                model.metrics.count("astar_calls", astarCalls)
+                for key, newPath, wantsMove in tilePlans:
+                    plans[key] = (newPath, wantsMove)
+
+        # Resolver los conflictos: en orden aleatorio, solo se mueve quien encuentra libre su siguiente celda
+        with model.metrics.timer("TiledActivation.apply"):
+            for car, (newPath, wantsMove) in zip(cars, plans):
+                if newPath is not None:
+                    car.path = newPath
+                nextCell = car.nextCell()
+                if nextCell is None:
+                    continue
+                if wantsMove and not model.grid.hasCar(nextCell):
+                    car.advance(model)
+                else:
+                    car.estado = False
@@ -0,0 +1,157 @@
+from itertools import count
+import heapq
+
+
+class PathFinder:
+    """
+    A* over the compiled lane graph, using integer cell ids and flat arrays instead of NetworkX.
+    The heuristic is the Chebyshev distance (every edge moves at most one cell in each axis)
+    times the cheapest edge weight, so it never overestimates and the paths are still the shortest.
+    Without the heuristic the search expands the cells in the same order as nx.astar_path without one
+    (cost, then insertion order), so it returns exactly the same path; the lane changes use it that way,
+    because among paths of the same cost the heuristic can pick a different one and change the simulation.
+    The search buffers are allocated once and reused: each query gets a new stamp, and a cell's
+    entries are only valid if its stamp matches, so there is nothing to clear between queries.
+    Attributes:
+        width: Width of the grid
+        height: Height of the grid
+        minWeight: Cheapest edge weight of the graph
+    """
+    def __init__(self, compiledMap):
+        """
+        Creates the path finder.
+        Args:
+            compiledMap: CompiledMap of the city (CityModel.compiledMap)
+        """
+        self.width = compiledMap.width
+        self.height = compiledMap.height
+
+        # Listas de Python: indexarlas es mucho mas rapido que indexar arreglos de NumPy de uno en uno
+        self._indptr = compiledMap.indptr.tolist()
+        self._indices = compiledMap.indices.tolist()
+        self._weights = compiledMap.weights.tolist()
+        self.minWeight = min(self._weights, default = 1)
+
+        numCells = self.width * self.height
+        self._x = [cell // self.height for cell in range(numCells)]
+        self._y = [cell % self.height for cell in range(numCells)]
+
+        # Buffers reutilizables de la busqueda
+        self._cost = [0] * numCells
+        self._parent = [-1] * numCells
+        self._seen = [0] * numCells
+        self._closed = [0] * numCells
+        self._stamp = 0
+
+    def cellId(self, pos):
+        ''' Returns the index of a cell. '''
+        return pos[0] * self.height + pos[1]
+
+    def cellPos(self, cell):
+        ''' Returns the (x, y) position of a cell index. '''
+        return (self._x[cell], self._y[cell])
+
+    def successors(self, cell):
+        ''' Returns the cells reachable in one step from the cell. '''
+        return self._indices[self._indptr[cell]:self._indptr[cell + 1]]
+
+    def edges(self, cell):
+        ''' Returns the (cell, weight) pairs of the edges that leave the cell. '''
+        start, end = self._indptr[cell], self._indptr[cell + 1]
+        return list(zip(self._indices[start:end], self._weights[start:end]))
+
+    def search(self, source, target, overrides = None, heuristic = True):
+        '''
+        Runs A* between two cells.
+        Args:
+            source: Starting cell
+            target: Destination cell
+            overrides: Dictionary (u, v) of cells -> weight that replaces the weight of those edges for this query
+            heuristic: Whether to use the Chebyshev heuristic (False gives the same path as nx.astar_path)
+        Returns the cells of the path without the source, or None if the target can't be reached.
+        '''
+        if source == target:
+            return []
+
+        self._stamp += 1
+        stamp = self._stamp
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        xs, ys = self._x, self._y
+        cost, parent, seen, closed = self._cost, self._parent, self._seen, self._closed
+
+        # Si algun peso temporal es menor, la heuristica tiene que usarlo para no sobreestimar
+        minWeight = self.minWeight
+        if overrides:
+            minWeight = min(minWeight, min(overrides.values()))
+        # Con peso 0 la heuristica siempre vale 0 (Dijkstra)
+        if not heuristic:
+            minWeight = 0
+        targetX, targetY = xs[target], ys[target]
+
+        # El contador desempata en orden de insercion (como nx.astar_path)
+        counter = count()
+        cost[source], parent[source], seen[source] = 0, -1, stamp
+        queue = [(max(abs(xs[source] - targetX), abs(ys[source] - targetY)) * minWeight, next(counter), source)]
+
+        while queue:
+            _, _, cell = heapq.heappop(queue)
+
+            if cell == target:
+                path = []
+                while cell != source:
+                    path.append(cell)
+                    cell = parent[cell]
+                path.reverse()
+                return path
+
+            if closed[cell] == stamp:
+                continue
+            closed[cell] = stamp
+
+            cellCost = cost[cell]
+            for k in range(indptr[cell], indptr[cell + 1]):
+                neighbor = indices[k]
+                if closed[neighbor] == stamp:
+                    continue
+
+                weight = weights[k]
+                if overrides:
+                    weight = overrides.get((cell, neighbor), weight)
+                newCost = cellCost + weight
+
+                if seen[neighbor] != stamp or newCost < cost[neighbor]:
+                    cost[neighbor], parent[neighbor], seen[neighbor] = newCost, cell, stamp
+                    heuristic = max(abs(xs[neighbor] - targetX), abs(ys[neighbor] - targetY)) * minWeight
+                    heapq.heappush(queue, (newCost + heuristic, next(counter), neighbor))
+
+        return None
+
+    def path(self, source, target, overrides = None, heuristic = True):
+        '''
+        Like search, but with (x, y) positions.
+        Returns the path without the source, or an empty list if there is no path.
+        '''
+        path = self.search(self.cellId(source), self.cellId(target), overrides, heuristic)
+        return [self.cellPos(cell) for cell in path] if path else []
+
+
+def lane_change_path(pathFinder, hasCar, source, target, penalty = 1000):
+    '''
+    Returns the shortest path (without the source) that avoids the cars next to the source:
+    the edges into a cell with a car, up to two steps away, get the penalty as weight.
+    hasCar(pos) tells whether there is a car in a cell.
+    The search runs without heuristic, so the route is the same one NetworkX chose (see PathFinder).
+    '''
+    cell = pathFinder.cellId(source)
+
+    # Pesos temporales para esta consulta (sin copiar ni modificar el grafo compartido)
+    penalties = {}
+    for f in pathFinder.successors(cell):
+        if hasCar(pathFinder.cellPos(f)):
+            penalties[(cell, f)] = penalty
+
+        for h in pathFinder.successors(f):
+            if hasCar(pathFinder.cellPos(h)):
+                penalties[(f, h)] = penalty
+
+    return pathFinder.path(source, target, penalties, heuristic = False)
@@ -0,0 +1,167 @@
+from itertools import count
+import heapq
+
+
+class ReservationTable:
+    """
+    Space-time reservations of the cells: which car will be in a cell at a given step.
+    Only a window of steps is ever reserved, and the past steps are dropped with expire.
+    Attributes:
+        cells: Dictionary step -> dictionary cell -> id of the car that reserved it
+        owned: Dictionary car id -> (step, cell) pairs it reserved
+    """
+    def __init__(self):
+        self.cells = {}
+        self.owned = {}
+        self._expired = 0
+
+    def reserve(self, carId, cell, step):
+        self.cells.setdefault(step, {})[cell] = carId
+        self.owned.setdefault(carId, []).append((step, cell))
+
+    def isReserved(self, cell, step, carId = None):
+        ''' Whether the cell is reserved at the step by another car. '''
+        owner = self.cells.get(step, {}).get(cell)
+        return owner is not None and owner != carId
+
+    def release(self, carId):
+        ''' Removes every reservation of a car. '''
+        for step, cell in self.owned.pop(carId, ()):
+            reserved = self.cells.get(step)
+            if reserved is not None and reserved.get(cell) == carId:
+                del reserved[cell]
+
+    def expire(self, step):
+        ''' Drops the reservations of the steps before the given one. '''
+        for past in range(self._expired, step):
+            self.cells.pop(past, None)
+        self._expired = max(self._expired, step)
+
+
+class CooperativePlanner:
+    """
+    Windowed cooperative A* (WHCA*): each car plans the next `window` steps over (cell, step) states,
+    around the cells other cars already reserved, and reserves the cells of its plan.
+    A car can also wait in its cell (the cell is repeated in the path), except in the cells where new cars
+    appear (car generators) and the cells right after them, where it would block the next new car. The heuristic is the exact
+    distance to the destination without other cars, read from the route table, so once the window
+    ends the rest of the route is already known to be the shortest one. When the car reaches the
+    end of its window it plans again (like a car without a route).
+    Attributes:
+        window: Number of steps planned and reserved at a time
+        table: ReservationTable shared by every car
+        noWait: Cells where the cars can't wait
+    """
+    def __init__(self, pathFinder, routeTable, window = 8, noWait = ()):
+        """
+        Creates the planner.
+        Args:
+            pathFinder: PathFinder of the city (for the lane graph)
+            routeTable: RouteTable of the city (for the heuristic and the routes without reservations)
+            window: Number of steps planned and reserved at a time
+            noWait: Positions where the cars can't wait (the car generators)
+        """
+        self.pathFinder = pathFinder
+        self.routeTable = routeTable
+        self.window = window
+        self.table = ReservationTable()
+        # Tampoco se espera en la salida de esas celdas, para no dejar atorado al coche que acaba de aparecer
+        self.noWait = {pathFinder.cellId(pos) for pos in noWait}
+        self.noWait.update(cell for source in list(self.noWait) for cell in pathFinder.successors(source))
+        self._distances = {}
+
+    def distances(self, destination):
+        ''' Distance from every cell to the destination, as a list (read once from the route table). '''
+        if destination not in self._distances:
+            self._distances[destination] = self.routeTable.distance[destination].tolist()
+        return self._distances[destination]
+
+    def plan(self, carId, source, destination, step, blocked, canLeave = True):
+        '''
+        Plans and reserves the next steps of a car.
+        Args:
+            carId: ID of the car
+            source: Position of the car
+            destination: Position of the destination
+            step: Current step (the first cell of the path is reserved for step + 1)
+            blocked(pos): Whether the car can't enter the cell right now (it has a car)
+            canLeave: Whether the car can leave its cell right now (False on a red light)
+        Returns the path without the source (waits repeat the cell), or the route without reservations
+        if every option is reserved.
+        '''
+        self.table.release(carId)
+        pathFinder = self.pathFinder
+        cells = self.search(carId, pathFinder.cellId(source), pathFinder.cellId(destination), step,
+                            lambda cell: blocked(pathFinder.cellPos(cell)), canLeave)
+        if cells is None:
+            return self.routeTable.route(source, destination)
+
+        for k, cell in enumerate(cells):
+            self.table.reserve(carId, cell, step + k + 1)
+        return tuple(pathFinder.cellPos(cell) for cell in cells)
+
+    def hold(self, carId, source, path, step):
+        '''
+        Moves the reservations of a car that couldn't move one step later, without searching again:
+        it stays in its cell for step + 1 and follows the rest of its path after that.
+        The cells already reserved by other cars are skipped.
+        '''
+        self.table.release(carId)
+        cellId = self.pathFinder.cellId
+        for k, pos in enumerate([source, *path[:self.window - 1]]):
+            cell = cellId(pos)
+            if not self.table.isReserved(cell, step + k + 1, carId):
+                self.table.reserve(carId, cell, step + k + 1)
+
+    def search(self, carId, source, target, step, blocked, canLeave = True):
+        '''
+        Runs A* over (cell, time) states for up to `window` steps (time 0 is the current step).
+        Returns the cells of the path without the source, or None if there is none.
+        '''
+        distance = self.distances(self.pathFinder.cellPos(target))
+        if distance[source] == float("inf"):
+            return None
+
+        edges = self.pathFinder.edges
+        isReserved = self.table.isReserved
+        noWait = self.noWait
+        window = self.window
+
+        # El contador desempata en orden de insercion
+        counter = count()
+        best = {(source, 0): 0}
+        parent = {}
+        queue = [(distance[source], next(counter), 0, source, 0)]
+
+        while queue:
+            _, _, cost, cell, time = heapq.heappop(queue)
+            if cost > best[(cell, time)]:
+                continue
+
+            if cell == target or time == window:
+                path = []
+                state = (cell, time)
+                while state != (source, 0):
+                    path.append(state[0])
+                    state = parent[state]
+                path.reverse()
+                return path
+
+            nextTime = time + 1
+            # Esperar en la celda cuesta un step, igual que el paso mas barato
+            moves = edges(cell) if cell in noWait else edges(cell) + [(cell, 1)]
+            for neighbor, weight in moves:
+                if distance[neighbor] == float("inf") or isReserved(neighbor, step + nextTime, carId):
+                    continue
+                # En el primer step se ven los coches que ya estan en el grid y el semaforo de la celda
+                if nextTime == 1 and neighbor != cell and (not canLeave or blocked(neighbor)):
+                    continue
+
+                newCost = cost + weight
+                state = (neighbor, nextTime)
+                if newCost < best.get(state, float("inf")):
+                    best[state] = newCost
+                    parent[state] = (cell, time)
+                    heapq.heappush(queue, (newCost + distance[neighbor], next(counter), newCost, neighbor, nextTime))
+
+        return None
@@ -0,0 +1,111 @@
+import heapq
+import numpy as np
+
+
+def dijkstra(graph, source, numCells):
+    '''
+    Runs Dijkstra from the source over a graph in CSR format (indptr, indices, weights as lists).
+    Returns the cell each cell was reached from (-1 if it wasn't) and the cost of every cell (inf if it wasn't).
+    '''
+    indptr, indices, weights = graph
+    previous = [-1] * numCells
+    distance = [float("inf")] * numCells
+
+    distance[source] = 0
+    queue = [(0, source)]
+
+    while queue:
+        cost, cell = heapq.heappop(queue)
+        if cost > distance[cell]:
+            continue
+
+        for k in range(indptr[cell], indptr[cell + 1]):
+            neighbor = indices[k]
+            newCost = cost + weights[k]
+            if newCost < distance[neighbor]:
+                distance[neighbor] = newCost
+                previous[neighbor] = cell
+                heapq.heappush(queue, (newCost, neighbor))
+
+    return previous, distance
+
+
+class RouteTable:
+    """
+    Precomputed shortest routes from every cell to every destination.
+    For each destination a reverse shortest-path tree is built once, and stored as a
+    next-hop array indexed by cell, so a route is read in O(path length).
+    The routes that have been read are kept as tuples, and every car with the same source and
+    destination shares the same tuple.
+    Attributes:
+        width: Width of the grid
+        height: Height of the grid
+        nextHop: Dictionary destination position -> array with the next cell of every cell (-1 if unreachable)
+        distance: Dictionary destination position -> array with the cost from every cell to the destination
+        routes: Dictionary (source cell, destination position) -> route already read
+    """
+    def __init__(self, compiledMap, destinations):
+        """
+        Creates the route table.
+        Args:
+            compiledMap: CompiledMap of the city (CityModel.compiledMap)
+            destinations: Positions of the destinations
+        """
+        self.width = compiledMap.width
+        self.height = compiledMap.height
+        self.nextHop = {}
+        self.distance = {}
+        self.routes = {}
+
+        # Predecesores de cada celda en CSR (Dijkstra se corre hacia atras)
+        indptr, indices, weights = compiledMap.reverse()
+        reverse = (indptr.tolist(), indices.tolist(), weights.tolist())
+
+        for destination in destinations:
+            self.nextHop[destination], self.distance[destination] = self.build_tree(reverse, destination)
+
+    def cellId(self, pos):
+        ''' Returns the index of a cell in the arrays. '''
+        return pos[0] * self.height + pos[1]
+
+    def cellPos(self, cell):
+        ''' Returns the (x, y) position of a cell index. '''
+        return divmod(int(cell), self.height)
+
+    def build_tree(self, reverse, destination):
+        '''
+        Runs Dijkstra backwards from the destination over the predecessors of each cell
+        (reverse is the predecessor CSR as lists: indptr, indices, weights).
+        Returns the next-hop and distance arrays.
+        '''
+        nextHop, distance = dijkstra(reverse, self.cellId(destination), self.width * self.height)
+        return np.array(nextHop, dtype=np.int32), np.array(distance)
+
+    def reachable(self, source, destination):
+        ''' Whether the destination can be reached from the source. '''
+        return source == destination or self.nextHop[destination][self.cellId(source)] >= 0
+
+    def route(self, source, destination):
+        '''
+        Returns the path from source to destination (without the source) as a tuple,
+        or an empty tuple if there is no path. The tuple is shared, so it must not be changed.
+        '''
+        cell = self.cellId(source)
+        key = (cell, destination)
+        route = self.routes.get(key)
+        if route is not None:
+            return route
+
+        nextHop = self.nextHop[destination]
+        target = self.cellId(destination)
+        path = []
+        while cell != target:
+            cell = nextHop[cell]
+            if cell < 0:
+                path = []
+                break
+            path.append(self.cellPos(cell))
+
+        route = self.routes[key] = tuple(path)
+        return route
+
@@ -0,0 +1,37 @@
+from mesa.time import RandomActivation
+from legoCity_Agents.agent import Car
+
+
+class CarPhaseActivation(RandomActivation):
+    """
+    Base of the schedulers that move all the cars in one phase instead of calling Car.step for each one
+    (FleetActivation and TiledActivation). Each step the agents are shuffled, the agents that are not cars
+    (traffic lights, intersections, car generators) step in random order, and then step_cars moves the cars.
+    """
+    def step(self):
+        model = self.model
+        agents = self.agents
+        model.random.shuffle(agents)
+        # Los coches que se generen en este step no se mueven hasta el siguiente (igual que RandomActivation)
+        cars = [agent for agent in agents if isinstance(agent, Car)]
+
+        with model.metrics.timer(f"{type(self).__name__}.agents"):
+            for agent in agents:
+                if not isinstance(agent, Car):
+                    agent.step()
+
+        self.step_cars(cars)
+        self.steps += 1
+        self.time += 1
+
+    def step_cars(self, cars):
+        ''' Moves the cars (in activation order). '''
+        raise NotImplementedError
+
+    def extend_routes(self, cars, cells = 5):
+        '''
+        Extends the routes of the cars that have less than `cells` cells left before the destination, so they
+        can still change lanes (HierarchicalRouter returns the route only up to the next cluster).
+        '''
+        for car in cars:
+            car.extendRoute(cells)
@@ -0,0 +1,132 @@
+from mesa.space import MultiGrid
+from legoCity_Agents.agent import Car, Traffic_Light, Obstacle, Destination, Road, Car_Generator
+from legoCity_Agents.mapcompiler import (EMPTY, ROAD, TRAFFIC_LIGHT, OBSTACLE, DESTINATION, CAR_GENERATOR,
+                                         NO_DIRECTION, DIRECTIONS, DIRECTION_CODES, LEFT, RIGHT, UP, DOWN)
+import numpy as np
+
+CELL_TYPES = {
+    Road: ROAD,
+    Traffic_Light: TRAFFIC_LIGHT,
+    Obstacle: OBSTACLE,
+    Destination: DESTINATION,
+    Car_Generator: CAR_GENERATOR,
+}
+
+
+class CityGrid(MultiGrid):
+    """
+    MultiGrid that keeps NumPy layers of the city in sync with place_agent, move_agent and remove_agent.
+    Every layer is indexed by (x, y), just like the grid.
+    Attributes:
+        cellType: Code of the static agent of each cell (EMPTY, ROAD, TRAFFIC_LIGHT, ...)
+        direction: Code of the direction of each cell (see DIRECTIONS)
+        trafficLightIndex: Index in trafficLights of the traffic light of each cell (-1 if there is none)
+        trafficLights: Traffic lights in the order they were placed
+        carCount: Number of cars in each cell
+        collisions: Cells (that are not destinations) with two or more cars
+    """
+    def __init__(self, width, height, torus):
+        super().__init__(width, height, torus)
+        self.cellType = np.zeros((width, height), dtype=np.int8)
+        self.direction = np.full((width, height), NO_DIRECTION, dtype=np.int8)
+        self.trafficLightIndex = np.full((width, height), -1, dtype=np.int32)
+        self.trafficLights = []
+        self.carCount = np.zeros((width, height), dtype=np.int32)
+        self.collisions = set()
+
+        # Para no contar dos veces cuando move_agent usa place_agent y remove_agent
+        self._moving = False
+
+    def place_agent(self, agent, pos):
+        super().place_agent(agent, pos)
+        if self._moving:
+            return
+
+        if isinstance(agent, Car):
+            self.car_entered(agent.pos)
+        else:
+            self.register_static(agent, agent.pos)
+
+    def move_agent(self, agent, pos):
+        if not isinstance(agent, Car):
+            super().move_agent(agent, pos)
+            return
+
+        old_pos = agent.pos
+        self._moving = True
+        try:
+            super().move_agent(agent, pos)
+        finally:
+            self._moving = False
+
+        self.car_left(old_pos)
+        self.car_entered(agent.pos)
+
+    def move_cars(self, cars, positions):
+        '''
+        Moves many cars at once (like move_agent for each one) and updates the car counts in one go.
+        The cars must all be different.
+        '''
+        if not cars:
+            return
+
+        oldPositions = [car.pos for car in cars]
+        self._moving = True
+        try:
+            for car, pos in zip(cars, positions):
+                MultiGrid.move_agent(self, car, pos)
+        finally:
+            self._moving = False
+
+        old = tuple(np.array(oldPositions).T)
+        new = tuple(np.array(positions).T)
+        np.subtract.at(self.carCount, old, 1)
+        np.add.at(self.carCount, new, 1)
+
+        # Solo pueden cambiar las colisiones de las celdas que se tocaron
+        for pos in oldPositions:
+            if self.carCount[pos] < 2:
+                self.collisions.discard(pos)
+        for pos in positions:
+            if self.carCount[pos] >= 2 and self.cellType[pos] != DESTINATION:
+                self.collisions.add(pos)
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        super().remove_agent(agent)
+        if not self._moving and isinstance(agent, Car):
+            self.car_left(pos)
+
+    def car_entered(self, pos):
+        ''' Counts a car entering the cell and registers the cell if two cars share it. '''
+        self.carCount[pos] += 1
+        if self.carCount[pos] >= 2 and self.cellType[pos] != DESTINATION:
+            self.collisions.add(pos)
+
+    def car_left(self, pos):
+        ''' Counts a car leaving the cell and unregisters the cell if it no longer has a collision. '''
+        self.carCount[pos] -= 1
+        if self.carCount[pos] < 2:
+            self.collisions.discard(pos)
+
+    def register_static(self, agent, pos):
+        ''' Stores the type, direction and traffic light index of a static agent. '''
+        # Solo el primer agente de la celda define su tipo (igual que grid[x][y][0])
+        if self.cellType[pos] != EMPTY:
+            return
+
+        self.cellType[pos] = CELL_TYPES.get(type(agent), EMPTY)
+        self.direction[pos] = DIRECTION_CODES.get(getattr(agent, "direction", None), NO_DIRECTION)
+
+        if isinstance(agent, Traffic_Light):
+            self.trafficLightIndex[pos] = len(self.trafficLights)
+            self.trafficLights.append(agent)
+
+    def hasCar(self, pos):
+        ''' Whether there is at least one car in the cell. '''
+        return self.carCount[pos] > 0
+
+    def trafficLightAt(self, pos):
+        ''' Returns the traffic light in the cell, or None. '''
+        index = self.trafficLightIndex[pos]
+        return self.trafficLights[index] if index >= 0 else None
@@ -0,0 +1,152 @@
+"""
+Signal timing optimizer for CityModel.
+
+Searches the time to change and the offset of every intersection (see CityModel.set_signal_timings)
+with a genetic algorithm whose first generation is a random search. Every candidate is simulated
+headlessly for each seed across a process pool, and its score is the mean number of arrived cars;
+a candidate with a collision in any seed ranks below every candidate without collisions.
+
+Example:
+    python optimize_signals.py --generations 10 --population 24 --seeds 0 1 --workers 4
+    python optimize_signals.py --cycles 3 12 --steps 500 --output best_signals.json
+"""
+from concurrent.futures import ProcessPoolExecutor
+from legoCity_Agents.model import CityModel, DEFAULT_MAP
+import argparse
+import json
+import random
+import time
+
+
+def run_candidate(params):
+    '''
+    Runs the signal timings of a candidate once per seed.
+    Returns the parameters together with the arrived cars and collision step of each seed.
+    '''
+    arrived = []
+    collisionSteps = []
+    for seed in params["seeds"]:
+        model = CityModel(mapFile = params["mapFile"], carGeneratorTime = params["generatorTime"],
+                          maxSteps = params["steps"], verbose = False, collectMetrics = False, seed = seed,
+                          signalTimings = params["timings"], intersectionControl = params["intersectionControl"])
+
+        collisionStep = None
+        while model.running and model.schedule.steps < params["steps"]:
+            model.step()
+            if model.checkCollision():
+                collisionStep = model.schedule.steps
+                break
+
+        arrived.append(model.numArrivedCars)
+        collisionSteps.append(collisionStep)
+
+    return dict(params, arrived = arrived, collisionSteps = collisionSteps,
+                collisionFree = all(step is None for step in collisionSteps),
+                meanArrived = sum(arrived) / len(arrived))
+
+
+def score(result):
+    ''' Sort key of a candidate: first without collisions, then by mean arrived cars. '''
+    return (result["collisionFree"], result["meanArrived"])
+
+
+def random_timing(rng, cycles):
+    cycle = rng.randint(*cycles)
+    return [cycle, rng.randrange(cycle)]
+
+
+def crossover(rng, first, second):
+    ''' Takes the timing of each intersection from one of the parents. '''
+    return [list(rng.choice(pair)) for pair in zip(first, second)]
+
+
+def mutate(rng, timings, cycles, rate):
+    ''' Changes the cycle or the offset of some intersections. '''
+    mutated = []
+    for cycle, offset in timings:
+        if rng.random() < rate:
+            if rng.random() < 0.5:
+                cycle = min(max(cycle + rng.choice([-1, 1]), cycles[0]), cycles[1])
+            offset = rng.randrange(cycle)
+        mutated.append([cycle, offset % cycle])
+    return mutated
+
+
+def tournament(rng, results, size):
+    return max(rng.sample(results, min(size, len(results))), key = score)
+
+
+def optimize(args):
+    '''
+    Runs the genetic algorithm and returns every evaluated candidate, best first.
+    The first generation also includes the times of the dictionary as a baseline (timings None).
+    '''
+    rng = random.Random(args.seed)
+    numIntersections = len(CityModel(mapFile = args.map, verbose = False, collectMetrics = False).intersections)
+    cycles = tuple(args.cycles)
+
+    base = {"mapFile": args.map, "generatorTime": args.generator_time, "seeds": args.seeds, "steps": args.steps,
+            "intersectionControl": args.intersection_control}
+    population = [[random_timing(rng, cycles) for _ in range(numIntersections)] for _ in range(args.population)]
+    history = []
+
+    with ProcessPoolExecutor(max_workers = args.workers) as executor:
+        baseline = executor.submit(run_candidate, dict(base, timings = None))
+
+        for generation in range(args.generations):
+            start = time.perf_counter()
+            results = [dict(result, generation = generation)
+                       for result in executor.map(run_candidate, [dict(base, timings = timings) for timings in population])]
+            if generation == 0:
+                results.append(dict(baseline.result(), generation = 0))
+            history.extend(results)
+
+            best = max(results, key = score)
+            print(f"Generation {generation}: best {best['meanArrived']:.1f} arrived cars "
+                  f"({'no collisions' if best['collisionFree'] else 'with collisions'}), {time.perf_counter() - start:.1f} s")
+
+            # Los mejores pasan tal cual, el resto se cruza y muta a partir de ellos
+            ranked = sorted((r for r in results if r["timings"] is not None), key = score, reverse = True)
+            population = [r["timings"] for r in ranked[:args.elite]]
+            while len(population) < args.population:
+                child = crossover(rng, tournament(rng, ranked, args.tournament)["timings"],
+                                  tournament(rng, ranked, args.tournament)["timings"])
+                population.append(mutate(rng, child, cycles, args.mutation_rate))
+
+    return sorted(history, key = score, reverse = True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Search the traffic light timings that maximize the arrived cars.")
+    parser.add_argument("--map", default = DEFAULT_MAP, help = "Map file to optimize")
+    parser.add_argument("--generator-time", type = int, default = None, help = "Steps between each generated car")
+    parser.add_argument("--seeds", nargs = "+", type = int, default = [0], help = "Seeds each candidate is simulated with")
+    parser.add_argument("--intersection-control", choices = ["independent", "grouped", "actuated"], default = "independent",
+                        help = "How the traffic lights of each intersection are stepped (see CityModel)")
+    parser.add_argument("--steps", type = int, default = 1000, help = "Steps of each run")
+    parser.add_argument("--cycles", nargs = 2, type = int, default = [2, 15], metavar = ("MIN", "MAX"),
+                        help = "Range of the time to change of each intersection")
+    parser.add_argument("--generations", type = int, default = 10, help = "Generations of the search (1 is a random search)")
+    parser.add_argument("--population", type = int, default = 24, help = "Candidates per generation")
+    parser.add_argument("--elite", type = int, default = 4, help = "Best candidates kept unchanged in the next generation")
+    parser.add_argument("--tournament", type = int, default = 3, help = "Candidates compared to pick each parent")
+    parser.add_argument("--mutation-rate", type = float, default = 0.2, help = "Probability of changing each intersection")
+    parser.add_argument("--seed", type = int, default = 0, help = "Seed of the search")
+    parser.add_argument("--workers", type = int, default = None, help = "Worker processes (one model per worker)")
+    parser.add_argument("--output", default = "signal_timings.json", help = "JSON file with the results")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = optimize(args)
+
+    with open(args.output, "w") as output:
+        json.dump({"best": results[0], "results": results}, output, indent = 2)
+
+    best = results[0]
+    print(f"Results saved to {args.output}")
+    if best["collisionFree"]:
+        print(f"Best schedule: {best['meanArrived']:.1f} arrived cars with timings {json.dumps(best['timings'])}")
+    else:
+        print("No schedule finished without collisions")
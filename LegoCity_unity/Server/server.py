@@ -1,88 +1,179 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, abort, request, jsonify, make_response
 from legoCity_Agents.model import CityModel
-from legoCity_Agents.agent import Car, Traffic_Light, Destination, Obstacle, Road, Car_Generator
+from sessions import SessionRegistry
+from snapshots import BINARY_MIMETYPE, collectChanges, prefersBinary
+from streaming import END_EVENT, KEEPALIVE_EVENT, SimulationRunner, stepEvent
+import os
 
 app = Flask("Traffic example")
 
+# Cada cliente tiene su propia simulacion (sesion); los limites se configuran con variables de entorno
+sessions = SessionRegistry(CityModel,
+                           maxSessions = int(os.environ.get("LEGOCITY_MAX_SESSIONS", 8)),
+                           ttl = float(os.environ.get("LEGOCITY_SESSION_TTL", 600)),
+                           workers = int(os.environ.get("LEGOCITY_STEP_WORKERS", 4)))
+
+def getSession():
+    """
+    Returns the session of the request (?session=<id> or the X-Session header).
+    Requests without an id use the last session created, like the single model the server used to have.
+    """
+    session = sessions.get(request.args.get('session') or request.headers.get('X-Session'))
+    if session is None:
+        abort(make_response(jsonify({"message":"Unknown or expired session. Call /init first."}), 404))
+    return session
+
+def wantsBinary():
+    """ Whether the client asked for the binary format (Accept: application/octet-stream) instead of JSON. """
+    return prefersBinary(request.headers.get('Accept'))
+
+def staticResponse(name):
+    """ Serves a precomputed payload from memory (304 if the client already has that version). """
+    body, etag = getSession().staticPayloads[name]
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 @app.route('/init', methods=['POST'])
 def initModel():
-    global randomModel, currentStep
-
-    currentStep = 0
-
     if request.method == 'POST':
-        randomModel = CityModel()
+        session = sessions.create()
 
-        return jsonify({"message":"Model initialized."})
+        return jsonify({"message":"Model initialized.", "session":session.id})
 
 @app.route('/getCars', methods=['GET'])
 def getCars():
-    global randomModel
-
     if request.method == 'GET':
-        # carPositions = [{"id": str(s.unique_id), "x": x, "y":1, "z":z} for a, (x, z) in randomModel.grid.coord_iter() for s in a if isinstance(s, Car)]
-        carPositions = [{"id": str(a.unique_id), "x": a.pos[0], "y":1, "z":a.pos[1]} for a in randomModel.schedule.agents if isinstance(a, Car)]
-
-        return jsonify({'positions':carPositions})
+        # Se lee el snapshot del ultimo step terminado (nunca un modelo a medio step)
+        snapshot = getSession().snapshot
+        if wantsBinary():
+            return Response(snapshot.carsBinary, mimetype=BINARY_MIMETYPE)
+        return Response(snapshot.carsJson, mimetype='application/json')
 
 @app.route('/getDestinations', methods=['GET'])
 def getDestinations():
-    global randomModel
-
     if request.method == 'GET':
-        DestinationsPositions = [{"id": str(s.unique_id), "x": x, "y":1, "z":z} for a, (x, z) in randomModel.grid.coord_iter() for s in a if isinstance(s, Destination)]
-        # DestinationsPositions = [{"id": str(a.unique_id), "x": a.pos[0], "y":1, "z":a.pos[1]} for a in randomModel.schedule.agents if isinstance(a, Destination)]
-
-        return jsonify({'positions':DestinationsPositions})
+        return staticResponse("destinations")
 
 @app.route('/getTrafficLights', methods=['GET'])
 def getTrafficLights():
-    global randomModel
-
     if request.method == 'GET':
-        trafficLights = [{"id": str(a.unique_id), "x": a.pos[0], "y":1, "z":a.pos[1], 
-                          "state": a.state, "direction": a.direction, 
-                          "timeToChange": a.timeToChange} 
-                          for a in randomModel.schedule.agents if isinstance(a, Traffic_Light)]
-
-        return jsonify({'positions':trafficLights})
+        return Response(getSession().snapshot.trafficLightsJson, mimetype='application/json')
 
 @app.route('/getObstacles', methods=['GET'])
 def getObstacles():
-    global randomModel
-
     if request.method == 'GET':
-        obstaclePositions = [{"id": str(s.unique_id), "x": x, "y":1, "z":z} for a, (x, z) in randomModel.grid.coord_iter() for s in a if isinstance(s, Obstacle)]
-
-        return jsonify({'positions':obstaclePositions})
+        return staticResponse("obstacles")
     
 
 @app.route('/getRoads', methods=['GET'])
 def getRoads():
-    global randomModel
-
     if request.method == 'GET':
-        roadPositions = [{"id": str(s.unique_id), "x": x, "y":1, "z":z} for a, (x, z) in randomModel.grid.coord_iter() for s in a if isinstance(s, (Road, Traffic_Light, Car_Generator))]
+        return staticResponse("roads")
 
-        return jsonify({'positions':roadPositions})
+@app.route('/getStaticWorld', methods=['GET'])
+def getStaticWorld():
+    if request.method == 'GET':
+        return staticResponse("world")
 
 @app.route('/getArrivedCars', methods=['GET'])
 def getArrivedCars():
-    global randomModel
-
     if request.method == 'GET':
-        arrivedCars = [{"id": str(a.unique_id)} for a in randomModel.arrivedCarsList]
-
-        return jsonify({'positions':arrivedCars})
+        snapshot = getSession().snapshot
+        if wantsBinary():
+            return Response(snapshot.arrivedCarsBinary, mimetype=BINARY_MIMETYPE)
+        return Response(snapshot.arrivedCarsJson, mimetype='application/json')
 
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    if request.method == 'GET':
+        return Response(getSession().snapshot.metricsJson, mimetype='application/json')
     
 @app.route('/update', methods=['GET'])
 def updateModel():
-    global currentStep, randomModel
     if request.method == 'GET':
-        randomModel.step()
-        currentStep += 1
+        currentStep = sessions.step(getSession())
         return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
 
+@app.route('/step', methods=['GET'])
+def stepModel():
+    """
+    Advances the model one step and returns, in a single response, only the cars that spawned,
+    moved or arrived and the traffic lights that changed since the client's last step (?since=<step>).
+    If the client is too far behind, every car and traffic light is sent instead ("full": true).
+    """
+    if request.method == 'GET':
+        session = getSession()
+        since = request.args.get('since', default = None, type = int)
+        if since is None:
+            since = session.snapshot.step
+
+        return jsonify(sessions.step(session, after = lambda s: collectChanges(s.model, since)))
+
+@app.route('/run', methods=['POST'])
+def runModel():
+    """
+    Starts stepping the model in the background (?rate=<steps per second>, as fast as possible if omitted).
+    The changes of every step are pushed to the clients of /stream, so the client stops driving the clock.
+    """
+    if request.method == 'POST':
+        session = getSession()
+        rate = request.args.get('rate', default = None, type = float)
+
+        if session.runner is None:
+            session.runner = SimulationRunner(session, rate)
+        session.runner.rate = rate
+        session.runner.start()
+
+        return jsonify({"message":"Model running.", "session":session.id, "rate":rate})
+
+@app.route('/pause', methods=['POST'])
+def pauseModel():
+    if request.method == 'POST':
+        session = getSession()
+        if session.runner is not None:
+            session.runner.stop()
+        return jsonify({"message":"Model paused.", "session":session.id})
+
+@app.route('/stream', methods=['GET'])
+def streamModel():
+    """
+    Server-Sent Events with the changes of each step of a running model ("step" events).
+    A slow client gets the pending steps merged in its next frame instead of every intermediate frame.
+    """
+    session = getSession()
+    if session.runner is None:
+        session.runner = SimulationRunner(session, None)
+    subscriber = session.runner.subscribe()
+    runner = session.runner
+
+    def events():
+        try:
+            while True:
+                try:
+                    frame = subscriber.next(timeout = 15)
+                except StopIteration:
+                    yield END_EVENT
+                    return
+
+                if frame is None:
+                    # Mantener viva la conexion mientras no hay steps nuevos (p. ej. antes de /run)
+                    yield KEEPALIVE_EVENT
+                    continue
+
+                changes, step = frame
+                yield stepEvent(changes, step, subscriber.dropped)
+        finally:
+            runner.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+@app.route('/close', methods=['POST'])
+def closeSession():
+    if request.method == 'POST':
+        session = getSession()
+        sessions.remove(session.id)
+        return jsonify({"message":"Session closed.", "session":session.id})
+
 if __name__=='__main__':
-    app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file
+    app.run(host="localhost", port=8585, debug=True, threaded=True)
@@ -0,0 +1,155 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from snapshots import ModelSnapshot, buildStaticPayloads
+import threading
+import time
+import uuid
+
+
+class Session:
+    """
+    One hosted simulation.
+    Attributes:
+        id: Session id returned by /init
+        model: The CityModel of the session
+        currentStep: Number of /update (or /step) calls of the session
+        data: Extra per-session data of the server
+        staticPayloads: Serialized static world of the model (see buildStaticPayloads)
+        runner: SimulationRunner that steps the model in the background (None if it is not free-running)
+        snapshot: ModelSnapshot of the last completed step (what the read endpoints serve)
+        lock: Lock held while the model is stepping
+        pendingSteps: Steps requested and not finished yet, as (future, after) pairs (the first one is running)
+        lastUsed: Time of the last request to the session
+    """
+    def __init__(self, sessionId, model):
+        self.id = sessionId
+        self.model = model
+        self.currentStep = 0
+        self.data = {}
+        self.runner = None
+        self.lock = threading.Lock()
+        self.pendingSteps = deque()
+        self._pendingLock = threading.Lock()
+        self.lastUsed = time.monotonic()
+        self.snapshot = ModelSnapshot(model, 0)
+        self.staticPayloads = buildStaticPayloads(model)
+
+    def step(self):
+        ''' Steps the model and publishes its new snapshot (the caller must hold the lock). '''
+        self.model.step()
+        self.currentStep += 1
+        self.snapshot = ModelSnapshot(self.model, self.currentStep)
+
+    def close(self):
+        ''' Stops everything that still runs for the session (called when it is evicted or removed). '''
+        if self.runner is not None:
+            self.runner.close()
+        # Esperar a que termine el step en curso antes de cerrar los workers del scheduler
+        with self.lock:
+            self.model.close()
+
+
+class SessionRegistry:
+    """
+    Registry of the hosted simulations, with LRU and TTL eviction and a cap on resident models.
+    Steps run on a worker pool so a slow step in one session doesn't block the requests of the others.
+    Each session has at most one step in the pool: the next steps of the session wait in its queue
+    (without taking a worker) and are sent to the pool when the previous one finishes.
+    Attributes:
+        factory: Function that creates the model of a new session
+        maxSessions: Maximum number of resident models (the least recently used is evicted)
+        ttl: Seconds a session can stay idle before it is evicted (a free-running or streamed session is never idle)
+        defaultId: Session used by the requests that don't send an id (the last one created)
+    """
+    def __init__(self, factory, maxSessions = 8, ttl = 600, workers = 4):
+        self.factory = factory
+        self.maxSessions = maxSessions
+        self.ttl = ttl
+        self.defaultId = None
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "step")
+
+    def create(self, **kwargs):
+        ''' Creates a new session (evicting the idle and least recently used ones if needed). '''
+        # Crear el modelo fuera del lock para no bloquear a las otras sesiones
+        session = Session(uuid.uuid4().hex, self.factory(**kwargs))
+
+        with self._lock:
+            evicted = self._evict_expired()
+            while len(self._sessions) >= self.maxSessions:
+                evicted.append(self._sessions.popitem(last = False)[1])
+            self._sessions[session.id] = session
+            self.defaultId = session.id
+
+        # Cerrarlas fuera del lock (cada una espera a que termine su step)
+        for old in evicted:
+            old.close()
+        return session
+
+    def get(self, sessionId = None):
+        ''' Returns the session (the default one if there is no id), or None if it doesn't exist or expired. '''
+        with self._lock:
+            evicted = self._evict_expired()
+            session = self._sessions.get(sessionId or self.defaultId)
+            if session is not None:
+                session.lastUsed = time.monotonic()
+                self._sessions.move_to_end(session.id)
+
+        for old in evicted:
+            old.close()
+        return session
+
+    def remove(self, sessionId):
+        with self._lock:
+            session = self._sessions.pop(sessionId, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def submit(self, session, after = None):
+        '''
+        Steps the model of the session in the worker pool and returns the future of the step.
+        If given, after(session) runs right after the step (still holding the session lock) and its result is the result of the future.
+        '''
+        future = Future()
+        with session._pendingLock:
+            session.pendingSteps.append((future, after))
+            if len(session.pendingSteps) == 1:
+                self._executor.submit(self._step, session)
+        return future
+
+    def step(self, session, after = None):
+        ''' Like submit, but waits for the step to finish. '''
+        return self.submit(session, after).result()
+
+    def _step(self, session):
+        future, after = session.pendingSteps[0]
+        if future.set_running_or_notify_cancel():
+            try:
+                with session.lock:
+                    session.step()
+                    result = after(session) if after else session.currentStep
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        # Mandar el siguiente step de la sesion al final de la cola del pool, detras de las otras sesiones
+        with session._pendingLock:
+            session.pendingSteps.popleft()
+            if session.pendingSteps:
+                self._executor.submit(self._step, session)
+
+    def _evict_expired(self):
+        ''' Removes the expired sessions (the caller holds the lock) and returns them, still to be closed. '''
+        now = time.monotonic()
+        # Una sesion que corre sola o que tiene clientes en /stream no recibe requests, pero sigue en uso
+        return [self._sessions.pop(sessionId) for sessionId in
+                [s.id for s in self._sessions.values()
+                 if now - s.lastUsed > self.ttl and not (s.runner is not None and s.runner.active)]]
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,147 @@
+from functools import cached_property
+from legoCity_Agents.agent import Car
+from legoCity_Agents.delta import StepDelta
+import hashlib
+import json
+import struct
+
+# Formato binario (little endian): encabezado (uint32 step, uint32 numero de coches)
+# y por cada coche (uint32 index, uint16 x, uint16 z). Los coches que llegaron son uint32 index.
+BINARY_MIMETYPE = "application/octet-stream"
+HEADER = struct.Struct("<II")
+CAR = struct.Struct("<IHH")
+CAR_INDEX = struct.Struct("<I")
+
+
+class ModelSnapshot:
+    """
+    Immutable copy of what the read endpoints return, taken after a completed step.
+    Readers use the last snapshot of a session, so they never see a model in the middle of a step.
+    Attributes:
+        step: Steps of the model's schedule
+        currentStep: Number of /update (or /step) calls of the session
+        cars: Tuple of (id, x, z) of every car
+        carIndexes: Tuple of the integer ID of every car (same order as cars)
+        trafficLights: Tuple of (id, x, z, state, direction, timeToChange) of every traffic light
+        arrivedCars: Ids of the cars that arrived in the last step
+        arrivedCarIndexes: Integer IDs of the cars that arrived in the last step
+        metrics: Summary of the model's metrics
+    """
+    def __init__(self, model, currentStep):
+        self.step = model.schedule.steps
+        self.currentStep = currentStep
+        cars = [a for a in model.schedule.agents if isinstance(a, Car)]
+        self.cars = tuple((str(a.unique_id), a.pos[0], a.pos[1]) for a in cars)
+        self.carIndexes = tuple(a.index for a in cars)
+        self.trafficLights = tuple((str(a.unique_id), a.pos[0], a.pos[1], a.state, a.direction, a.timeToChange)
+                                   for a in model.traffic_lights)
+        self.arrivedCars = tuple(str(a.unique_id) for a in model.arrivedCarsList)
+        self.arrivedCarIndexes = tuple(a.index for a in model.arrivedCarsList)
+        self.metrics = model.metrics.summary()
+
+    # Cada cuerpo JSON se serializa una sola vez, la primera vez que alguien lo pide
+    @cached_property
+    def carsJson(self):
+        return json.dumps({'positions': [{"id": carId, "index": index, "x": x, "y": 1, "z": z}
+                                         for index, (carId, x, z) in zip(self.carIndexes, self.cars)]}).encode()
+
+    @cached_property
+    def trafficLightsJson(self):
+        return json.dumps({'positions': [{"id": lightId, "x": x, "y": 1, "z": z, "state": state,
+                                          "direction": direction, "timeToChange": timeToChange}
+                                         for lightId, x, z, state, direction, timeToChange in self.trafficLights]}).encode()
+
+    @cached_property
+    def carsBinary(self):
+        body = bytearray(HEADER.size + CAR.size * len(self.cars))
+        HEADER.pack_into(body, 0, self.step, len(self.cars))
+        for i, (index, (carId, x, z)) in enumerate(zip(self.carIndexes, self.cars)):
+            CAR.pack_into(body, HEADER.size + i * CAR.size, index, x, z)
+        return bytes(body)
+
+    @cached_property
+    def arrivedCarsBinary(self):
+        body = bytearray(HEADER.size + CAR_INDEX.size * len(self.arrivedCarIndexes))
+        HEADER.pack_into(body, 0, self.step, len(self.arrivedCarIndexes))
+        for i, index in enumerate(self.arrivedCarIndexes):
+            CAR_INDEX.pack_into(body, HEADER.size + i * CAR_INDEX.size, index)
+        return bytes(body)
+
+    @cached_property
+    def arrivedCarsJson(self):
+        return json.dumps({'positions': [{"id": carId, "index": index}
+                                         for index, carId in zip(self.arrivedCarIndexes, self.arrivedCars)]}).encode()
+
+    @cached_property
+    def metricsJson(self):
+        return json.dumps(self.metrics).encode()
+
+
+def acceptQuality(accept, mimetype):
+    """ Quality that an Accept header gives to a MIME type (from its most specific matching range, 0 if none matches). """
+    mainType = mimetype.split("/")[0]
+    best = (-1, 0.0)
+    for item in (accept or "").split(","):
+        mediaRange, *params = [part.strip() for part in item.split(";")]
+        mediaRange = mediaRange.lower()
+        if mediaRange == mimetype:
+            specificity = 2
+        elif mediaRange == mainType + "/*":
+            specificity = 1
+        elif mediaRange == "*/*":
+            specificity = 0
+        else:
+            continue
+
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        best = max(best, (specificity, quality))
+    return best[1]
+
+
+def prefersBinary(accept):
+    """
+    Whether an Accept header prefers the binary format to JSON (used by both front ends).
+    JSON wins the ties, so a missing header or */* still gets JSON.
+    """
+    return acceptQuality(accept, BINARY_MIMETYPE) > acceptQuality(accept, "application/json")
+
+
+def buildStaticPayloads(model):
+    """
+    Serializes the static world of the model (roads, obstacles and destinations) once.
+    Returns a dictionary name -> (JSON body, ETag); "world" has all of them together with their version.
+    """
+    positions = {name: [{"id": str(a.unique_id), "x": a.pos[0], "y":1, "z":a.pos[1]} for a in agents]
+                 for name, agents in model.staticWorld.items()}
+    version = hashlib.sha1(json.dumps(positions, sort_keys=True).encode()).hexdigest()
+
+    payloads = {}
+    for name, agentPositions in positions.items():
+        body = json.dumps({'positions':agentPositions}).encode()
+        payloads[name] = (body, hashlib.sha1(body).hexdigest())
+    payloads["world"] = (json.dumps(dict(positions, version=version)).encode(), version)
+    return payloads
+
+
+def collectChanges(model, since):
+    """ Changes of the model since the step, or every car and traffic light if the history doesn't reach it. """
+    changes = model.changesSince(since)
+    full = changes is None
+    if full:
+        changes = StepDelta()
+        for a in model.schedule.agents:
+            if isinstance(a, Car):
+                changes.car_spawned(a)
+        for a in model.traffic_lights:
+            changes.light_changed(a)
+        for a in model.arrivedCarsList:
+            changes.car_arrived(a)
+
+    return dict(changes.as_dict(), currentStep = model.schedule.steps, full = full)
@@ -0,0 +1,159 @@
+from legoCity_Agents.delta import StepDelta
+import json
+import threading
+import time
+
+# Eventos de Server-Sent Events de /stream (los usan server.py y async_server.py)
+KEEPALIVE_EVENT = ": keepalive\n\n"
+END_EVENT = "event: end\ndata: {}\n\n"
+
+
+def stepEvent(changes, step, dropped):
+    ''' SSE "step" event with the changes of a frame. '''
+    data = dict(changes.as_dict(), currentStep = step, dropped = dropped)
+    return f"event: step\ndata: {json.dumps(data)}\n\n"
+
+
+class Subscriber:
+    """
+    Client of a running simulation. It keeps at most one pending frame: if the client is slower
+    than the simulation, new steps are merged into the pending frame (intermediate frames are dropped).
+    Attributes:
+        dropped: Number of frames that were merged because the client had not read the previous one
+        onPush: Function called (from the runner thread) when there is a new frame or the subscriber is closed
+    """
+    def __init__(self, onPush = None):
+        self.dropped = 0
+        self.onPush = onPush
+        self._pending = None
+        self._step = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def push(self, delta, step):
+        with self._condition:
+            if self._pending is None:
+                # Copia para no modificar el historial del modelo al combinar
+                self._pending = StepDelta().merge(delta)
+            else:
+                self._pending.merge(delta)
+                self.dropped += 1
+            self._step = step
+            self._condition.notify()
+        if self.onPush is not None:
+            self.onPush()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self.onPush is not None:
+            self.onPush()
+
+    def next(self, timeout = None):
+        '''
+        Waits for the next frame and returns (delta, step).
+        Returns None on timeout, and raises StopIteration once the runner stopped and every frame was read.
+        '''
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending is not None or self._closed, timeout)
+            if self._pending is None:
+                if self._closed:
+                    raise StopIteration
+                return None
+
+            frame = (self._pending, self._step)
+            self._pending = None
+            return frame
+
+
+class SimulationRunner:
+    """
+    Steps the model of a session in a background thread, at a target rate or as fast as it can,
+    and pushes the changes of every step to its subscribers.
+    Pausing (stop) keeps the subscribers: they get the next steps once the runner starts again, and
+    they are only closed when the model stops running or the session is closed.
+    Attributes:
+        session: Session whose model is stepped
+        rate: Target steps per second (None to run as fast as possible)
+    """
+    def __init__(self, session, rate = None):
+        self.session = session
+        self.rate = rate
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._control = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def active(self):
+        ''' Whether the model is running or some client is subscribed (the session is in use without requests). '''
+        with self._lock:
+            return self.running or bool(self._subscribers)
+
+    def start(self):
+        with self._control:
+            if self.running and not self._stop.is_set():
+                return
+            # Un hilo pausado puede seguir terminando su ultimo step: esperarlo antes de crear el nuevo
+            if self._thread is not None:
+                self._thread.join()
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = f"runner-{self.session.id}", daemon = True)
+            self._thread.start()
+
+    def stop(self):
+        ''' Pauses the runner (the subscribers stay open). '''
+        with self._control:
+            self._stop.set()
+
+    def close(self):
+        ''' Stops the runner and closes every subscriber (the session is gone). '''
+        self.stop()
+        self._close_subscribers()
+
+    def subscribe(self, onPush = None):
+        subscriber = Subscriber(onPush)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        # El modelo ya termino: no van a llegar mas steps
+        if not self.session.model.running:
+            subscriber.close()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _run(self):
+        model = self.session.model
+        nextStep = time.monotonic()
+
+        while not self._stop.is_set() and model.running:
+            with self.session.lock:
+                self.session.step()
+                delta, step = model.delta, model.schedule.steps
+
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for subscriber in subscribers:
+                subscriber.push(delta, step)
+
+            if self.rate:
+                nextStep += 1 / self.rate
+                self._stop.wait(max(0, nextStep - time.monotonic()))
+
+        # En pausa los clientes siguen conectados; solo se cierran cuando el modelo termina
+        if not model.running:
+            self._close_subscribers()
+
+    def _close_subscribers(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.close()